@@ -0,0 +1,303 @@
+"""
+Fast access to DBF files (e.g. TIGER featnames and faces): DBF reads them
+a record at a time through mmap, and ColumnarTable caches a whole file as
+NumPy arrays, one per field, which later reads load instead of parsing
+the DBF.
+
+NumPy is only needed for the columnar cache.
+"""
+
+import os
+import json
+import mmap
+import struct
+import decimal
+import datetime
+
+
+__all__ = ('DBF', 'ColumnarTable', 'numpy_available', 'load_rel_db')
+
+
+class DBF(object):
+    """
+    A memory-mapped DBF file, read a record at a time. Values are decoded
+    like ebdata.parsing.dbf.reader(..., strip_values=True) does.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.numrec, self.header_size, self.record_size = \
+            struct.unpack('<4xLHH20x', self.map[:32])
+        self.fields = []
+        offset = 1  # after the deletion flag
+        for i in xrange((self.header_size - 33) // 32):
+            start = 32 + 32 * i
+            name, typ, size, deci = struct.unpack(
+                '<11sc4xBB14x', self.map[start:start + 32])
+            name = name.replace('\0', '')
+            self.fields.append((name, typ, offset, size, deci))
+            offset += size
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def field(self, name):
+        for field in self.fields:
+            if field[0] == name:
+                return field
+        raise ValueError('{0} has no {1} field'.format(self.path, name))
+
+    def raw(self, recno):
+        start = self.header_size + recno * self.record_size
+        return self.map[start:start + self.record_size]
+
+    def keys(self, field):
+        """Yields (key, record number) for the records that aren't deleted."""
+        name, typ, offset, size, deci = field
+        for recno in xrange(self.numrec):
+            start = self.header_size + recno * self.record_size
+            if self.map[start] != ' ':
+                continue  # deleted record
+            yield key_of(self.map[start + offset:start + offset + size]), recno
+
+    def record(self, recno):
+        raw = self.raw(recno)
+        row = {}
+        for name, typ, offset, size, deci in self.fields:
+            row[name] = decode(typ, deci, raw[offset:offset + size])
+        return row
+
+
+def key_of(value):
+    return value.replace('\0', '').strip()
+
+
+def normalize_key(field, value):
+    """
+    Returns a key of ``field``, or a needle looked up in it, in a form
+    that is equal for equal values: numeric fields compare by value, so
+    '123.000', '0123' and '123' are the same key.
+    """
+    name, typ, offset, size, deci = field
+    if typ != 'N':
+        return key_of(value)
+    try:
+        number = decimal.Decimal(decode(typ, deci, value))
+    except (ValueError, decimal.InvalidOperation):
+        return key_of(value)
+    if number == number.to_integral_value():
+        return str(int(number))
+    return str(number.normalize())
+
+
+def decode(typ, deci, value):
+    if typ == 'N':
+        value = value.replace('\0', '').lstrip()
+        if value == '':
+            return 0
+        elif deci:
+            return decimal.Decimal(value)
+        return int(value)
+    elif typ == 'D':
+        try:
+            return datetime.date(int(value[:4]), int(value[4:6]),
+                                 int(value[6:8]))
+        except ValueError:
+            return None
+    elif typ == 'L':
+        return (value in 'YyTt' and 'T') or (value in 'NnFf' and 'F') or '?'
+    return value.strip()
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('The columnar DBF cache needs NumPy '
+                          '(pip install numpy)')
+    return numpy
+
+
+def numpy_available():
+    try:
+        _numpy()
+    except ImportError:
+        return False
+    return True
+
+
+class ColumnarTable(object):
+    """
+    A DBF converted to a directory of .npy files: integer fields as int64
+    arrays, every other field as an array of codes into a table of its
+    distinct raw values, which are decoded like DBF.record() does.
+    Deleted records are left out.
+    """
+
+    def __init__(self, path):
+        np = _numpy()
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.fields = [(str(name),) + tuple(rest)
+                       for name, rest in [(f[0], f[1:])
+                                          for f in self.meta['fields']]]
+        self._columns = {}
+        self._tables = {}
+        self.np = np
+
+    def __len__(self):
+        return self.meta['numrec']
+
+    @classmethod
+    def cache_path(cls, dbf_path):
+        return dbf_path + '.columns'
+
+    @classmethod
+    def open(cls, dbf_path):
+        """
+        Returns the table cached for ``dbf_path``, converting the DBF first
+        if it has no cache or has changed since.
+        """
+        path = cls.cache_path(dbf_path)
+        stat = os.stat(dbf_path)
+        try:
+            table = cls(path)
+        except (IOError, ValueError):
+            table = None
+        if table is None or table.meta['source'] != \
+                [stat.st_size, stat.st_mtime]:
+            cls.build(dbf_path)
+            table = cls(path)
+        return table
+
+    @classmethod
+    def build(cls, dbf_path):
+        """Converts ``dbf_path`` into its columnar cache."""
+        np = _numpy()
+        path = cls.cache_path(dbf_path)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        stat = os.stat(dbf_path)
+        dbf = DBF(dbf_path)
+        try:
+            dtype = np.dtype([('_deleted', 'S1')] +
+                             [(str(name), 'S%d' % size)
+                              for name, typ, offset, size, deci in dbf.fields])
+            if dtype.itemsize != dbf.record_size:
+                raise ValueError('{0}: unexpected record size'.format(
+                    dbf_path))
+            records = np.frombuffer(dbf.map, dtype=dtype, count=dbf.numrec,
+                                    offset=dbf.header_size)
+            records = records[records['_deleted'] == ' ']
+            fields = []
+            for name, typ, offset, size, deci in dbf.fields:
+                values = records[name]
+                if typ == 'N' and not deci:
+                    kind = 'int'
+                    values = np.char.strip(np.char.replace(values, '\0', ''))
+                    values[values == ''] = '0'
+                    np.save(os.path.join(path, name + '.npy'),
+                            values.astype(np.int64))
+                else:
+                    kind = 'table'
+                    table, codes = np.unique(values, return_inverse=True)
+                    np.save(os.path.join(path, name + '.npy'),
+                            codes.astype(np.int32))
+                    np.save(os.path.join(path, name + '.table.npy'), table)
+                fields.append((name, typ, size, deci, kind))
+            meta = {'source': [stat.st_size, stat.st_mtime],
+                    'numrec': len(records), 'fields': fields}
+        finally:
+            dbf.close()
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def _field(self, name):
+        for field in self.fields:
+            if field[0] == name:
+                return field
+        raise ValueError('{0} has no {1} field'.format(self.path, name))
+
+    def kind(self, name):
+        """Returns 'int' for integer fields, 'table' for the others."""
+        return self._field(name)[4]
+
+    def column(self, name):
+        """
+        Returns the raw array of a field: its values for integer fields,
+        codes into table(name) for the others.
+        """
+        if name not in self._columns:
+            self._columns[name] = self.np.load(
+                os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return self._columns[name]
+
+    def table(self, name):
+        """Returns the decoded distinct values of a non-integer field."""
+        if name not in self._tables:
+            name, typ, size, deci, kind = self._field(name)
+            raw = self.np.load(os.path.join(self.path, name + '.table.npy'))
+            table = self.np.empty(len(raw), dtype=object)
+            table[:] = [decode(typ, deci, value) for value in raw.tolist()]
+            self._tables[name] = table
+        return self._tables[name]
+
+    def values(self, name, indices=None):
+        """Returns the decoded values of a field, as an array."""
+        column = self.column(name)
+        if indices is not None:
+            column = column[indices]
+        if self.kind(name) == 'int':
+            return self.np.asarray(column)
+        return self.table(name)[column]
+
+    def where(self, name, values):
+        """Returns the indices of the rows whose field is one of values."""
+        column = self.column(name)
+        if self.kind(name) == 'int':
+            return self.np.nonzero(self.np.in1d(column, list(values)))[0]
+        values = set(values)
+        codes = [code for code, value in enumerate(self.table(name))
+                 if value in values]
+        return self.np.nonzero(self.np.in1d(column, codes))[0]
+
+    def group_by(self, name, indices=None):
+        """
+        Returns {value: row indices} for the distinct values of a field,
+        among the rows at ``indices`` if given.
+        """
+        np = self.np
+        if indices is None:
+            indices = np.arange(len(self))
+        column = np.asarray(self.column(name))[indices]
+        order = np.argsort(column, kind='mergesort')
+        keys, starts = np.unique(column[order], return_index=True)
+        groups = np.split(indices[order], starts[1:])
+        if self.kind(name) != 'int':
+            keys = self.table(name)[keys]
+        return dict(zip(keys.tolist(), groups))
+
+    def rows(self, indices=None):
+        """Returns the rows at ``indices`` (default all) as dictionaries."""
+        names = [field[0] for field in self.fields]
+        columns = [self.values(name, indices).tolist() for name in names]
+        return [dict(zip(names, row)) for row in zip(*columns)]
+
+
+def load_rel_db(dbf_path, rel_key):
+    """
+    Like TigerImporter._load_rel_db(), returns {rel_key value: row} for a
+    DBF, but reads its columnar cache.
+    """
+    table = ColumnarTable.open(dbf_path)
+    names = [field[0] for field in table.fields]
+    columns = [table.values(name).tolist() for name in names]
+    key = names.index(rel_key)
+    db = {}
+    for row in zip(*columns):
+        db[row[key]] = dict(zip(names, row))
+    return db
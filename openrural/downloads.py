@@ -0,0 +1,260 @@
+"""
+A download cache shared by the GIS import commands.
+
+Archives are stored once per content (by SHA-1) and looked up by URL, so
+re-running an import reuses what an earlier run fetched::
+
+    cache = DownloadCache()
+    paths = cache.fetch_many([url_a, url_b])
+    folder = cache.unzip(paths[url_a])
+
+An entry younger than DOWNLOAD_CACHE_MAX_AGE is used as is. Older ones
+are revalidated: HTTP servers are asked with If-Modified-Since, other
+URLs (e.g. FTP) are fetched again, and an archive whose content didn't
+change keeps its unzipped folder. Least recently used entries are removed
+once the cache grows past DOWNLOAD_CACHE_MAX_SIZE bytes.
+
+With a mirror directory, archives are read from there by file name
+instead of downloaded, so imports can run offline.
+"""
+
+import os
+import json
+import time
+import shutil
+import urllib2
+import hashlib
+import logging
+import tempfile
+import datetime
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+
+__all__ = ('DownloadCache', 'DownloadError')
+
+
+logger = logging.getLogger('openrural.downloads')
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DownloadCache(object):
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, path=None, mirror=None, max_size=None, max_age=None):
+        self.path = path or getattr(settings, 'DOWNLOAD_CACHE_DIR',
+                                    '/tmp/openrural_downloads')
+        self.mirror = mirror
+        self.max_size = max_size or getattr(settings,
+                                            'DOWNLOAD_CACHE_MAX_SIZE',
+                                            4 * 1024 ** 3)
+        self.max_age = max_age or getattr(settings, 'DOWNLOAD_CACHE_MAX_AGE',
+                                          datetime.timedelta(days=7))
+        for folder in ('objects', 'urls', 'unzipped'):
+            folder = os.path.join(self.path, folder)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+    def _meta_path(self, url):
+        return os.path.join(self.path, 'urls',
+                            hashlib.sha1(url).hexdigest() + '.json')
+
+    def _object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest)
+
+    def _load_meta(self, url):
+        try:
+            with open(self._meta_path(url)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _save_meta(self, url, meta):
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.path, 'urls'))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp, self._meta_path(url))
+
+    def _checksum(self, path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _store(self, source):
+        """
+        Copies the file-like ``source`` into the cache, returning the
+        SHA-1 of its content.
+        """
+        digest = hashlib.sha1()
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.path, 'objects'))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: source.read(self.chunk_size), ''):
+                    digest.update(chunk)
+                    f.write(chunk)
+            digest = digest.hexdigest()
+            os.rename(tmp, self._object_path(digest))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return digest
+
+    def _valid(self, meta):
+        """Whether the archive of an entry is present and intact."""
+        path = self._object_path(meta['digest'])
+        if not os.path.exists(path):
+            return False
+        if os.path.getsize(path) != meta['size'] or \
+                self._checksum(path) != meta['digest']:
+            logger.warning('%s is corrupt, discarding it', path)
+            os.remove(path)
+            return False
+        return True
+
+    def fetch(self, url):
+        """Returns the path of the cached archive downloaded from url."""
+        meta = self._load_meta(url)
+        if meta is not None and not self._valid(meta):
+            meta = None
+        now = time.time()
+        if self.mirror:
+            name = os.path.join(self.mirror, url.rsplit('/', 1)[-1])
+            if not os.path.exists(name):
+                raise DownloadError('{0} is not in the mirror {1}'.format(
+                    url, self.mirror))
+            mtime = os.path.getmtime(name)
+            if meta is None or meta.get('mirror_mtime') != mtime:
+                with open(name, 'rb') as f:
+                    digest = self._store(f)
+                meta = {'url': url, 'digest': digest, 'mirror_mtime': mtime,
+                        'size': os.path.getsize(self._object_path(digest))}
+        elif meta is None or now - meta['checked'] > self._max_age_seconds():
+            request = urllib2.Request(url)
+            if meta is not None and meta.get('last_modified'):
+                request.add_header('If-Modified-Since', meta['last_modified'])
+            try:
+                response = urllib2.urlopen(request)
+            except urllib2.HTTPError, e:
+                if e.code != 304 or meta is None:
+                    raise DownloadError('Could not download {0}: {1}'.format(
+                        url, e))
+                logger.debug('%s not modified', url)
+            except (urllib2.URLError, IOError), e:
+                raise DownloadError('Could not download {0}: {1}'.format(
+                    url, e))
+            else:
+                logger.info('Downloading %s', url)
+                try:
+                    digest = self._store(response)
+                finally:
+                    response.close()
+                meta = {'url': url, 'digest': digest,
+                        'last_modified': response.info().get('Last-Modified'),
+                        'size': os.path.getsize(self._object_path(digest))}
+            meta['checked'] = now
+        else:
+            logger.debug('%s is cached', url)
+        meta.setdefault('checked', now)
+        meta['used'] = now
+        self._save_meta(url, meta)
+        return self._object_path(meta['digest'])
+
+    def _max_age_seconds(self):
+        age = self.max_age
+        return age.days * 86400 + age.seconds
+
+    def fetch_many(self, urls, workers=4):
+        """
+        Fetches several URLs concurrently, returning {url: archive path}.
+        """
+        pool = ThreadPool(max(1, min(workers, len(urls))))
+        try:
+            paths = pool.map(self.fetch, urls)
+        finally:
+            pool.close()
+            pool.join()
+        # the caller hasn't unzipped them yet
+        self.prune(keep=paths)
+        return dict(zip(urls, paths))
+
+    def unzip(self, archive):
+        """
+        Extracts a cached archive, unless that content has been extracted
+        already, and returns the folder holding its files.
+        """
+        digest = os.path.basename(archive)
+        folder = os.path.join(self.path, 'unzipped', digest)
+        done = os.path.join(folder, '.complete')
+        if not os.path.exists(done):
+            if os.path.exists(folder):
+                shutil.rmtree(folder)
+            try:
+                zipfile.ZipFile(archive).extractall(folder)
+            except (zipfile.BadZipfile, IOError), e:
+                raise DownloadError('Could not unzip {0}: {1}'.format(
+                    archive, e))
+            open(done, 'w').close()
+        return folder
+
+    def _size(self, path):
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        total = 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                total += os.path.getsize(os.path.join(root, name))
+        return total
+
+    def prune(self, keep=()):
+        """
+        Removes the least recently used archives, and their unzipped
+        folders, until the cache is smaller than max_size. An archive
+        downloaded from several URLs is kept as long as any of them is,
+        and removed along with all of them. The archive paths in ``keep``
+        are never removed.
+        """
+        keep = set([os.path.basename(path) for path in keep])
+        # digest: [last used, URL entries]
+        digests = {}
+        urls = os.path.join(self.path, 'urls')
+        for name in os.listdir(urls):
+            try:
+                with open(os.path.join(urls, name)) as f:
+                    meta = json.load(f)
+            except (IOError, ValueError):
+                continue
+            entry = digests.setdefault(meta['digest'], [0, []])
+            entry[0] = max(entry[0], meta.get('used', 0))
+            entry[1].append(name)
+        entries = []
+        total = 0
+        for digest, (used, names) in digests.iteritems():
+            size = 0
+            if os.path.exists(self._object_path(digest)):
+                size = self._size(self._object_path(digest))
+            unzipped = os.path.join(self.path, 'unzipped', digest)
+            if os.path.exists(unzipped):
+                size += self._size(unzipped)
+            entries.append((used, digest, names, size))
+            total += size
+        entries.sort()
+        for used, digest, names, size in entries:
+            if total <= self.max_size:
+                break
+            if digest in keep:
+                continue
+            logger.info('Removing %s from the download cache', digest)
+            for name in names:
+                os.remove(os.path.join(urls, name))
+            if os.path.exists(self._object_path(digest)):
+                os.remove(self._object_path(digest))
+            shutil.rmtree(os.path.join(self.path, 'unzipped', digest), True)
+            total -= size
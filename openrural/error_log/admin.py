@@ -1,28 +1,76 @@
 from django.db import models
 from django.contrib import admin
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
 
-from openrural.error_log.models import Geocode, GeocodeBatch, Message
+from openrural.error_log.models import Geocode, GeocodeBatch, Message, \
+    MessageGroup, MessageSample, GeocodeStats, GeocodeFailureStats
 from openrural.error_log.forms import GeocodeForm, GoogleMapsLink
+from openrural.error_log.regeocode import regeocode
+from openrural.retrieval.geocoders import get_shared_geocoder
+
+
+def _rate_sql(numerator, denominator):
+    return ('CASE WHEN {1} > 0 THEN CAST({0} AS double precision) / {1} '
+            'ELSE 0 END').format(numerator, denominator)
 
 
 class BatchAdmin(admin.ModelAdmin):
     list_display = ('start_time', 'scraper', 'end_time', 'num', 'num_added',
                     'num_changed', 'num_skipped', 'num_geocoded',
-                    'num_geocoded_success', 'geocode_rate')
+                    'num_geocoded_success', 'geocode_rate', 'num_cache_hits',
+                    'num_cache_misses', 'memo_rate')
     list_filter = ('start_time', 'scraper')
     search_fields = ('batch__id', 'location', 'description')
     ordering = ('-start_time',)
 
+    def queryset(self, request):
+        qs = super(BatchAdmin, self).queryset(request)
+        return qs.extra(select={
+            'success_rate': _rate_sql('num_geocoded_success', 'num_geocoded'),
+            'memo_hit_rate': _rate_sql('num_memo_hits', 'num_geocoded'),
+        })
+
     def geocode_rate(self, obj):
-        if obj.num_geocoded > 0:
-            rate = float(obj.num_geocoded_success) / obj.num_geocoded
-        else:
-            rate = 0.0
-        return '{0:.2%}'.format(rate)
+        return '{0:.2%}'.format(obj.success_rate)
+    geocode_rate.admin_order_field = 'success_rate'
+
+    def memo_rate(self, obj):
+        return '{0:.2%}'.format(obj.memo_hit_rate)
+    memo_rate.admin_order_field = 'memo_hit_rate'
 
 admin.site.register(GeocodeBatch, BatchAdmin)
 
 
+class GeocodeStatsAdmin(admin.ModelAdmin):
+    list_display = ('date', 'scraper', 'num_batches', 'num_geocoded',
+                    'num_geocoded_success', 'geocode_rate')
+    list_filter = ('scraper',)
+    date_hierarchy = 'date'
+    ordering = ('-date', 'scraper')
+
+    def queryset(self, request):
+        qs = super(GeocodeStatsAdmin, self).queryset(request)
+        return qs.extra(select={
+            'success_rate': _rate_sql('num_geocoded_success', 'num_geocoded'),
+        })
+
+    def geocode_rate(self, obj):
+        return '{0:.2%}'.format(obj.success_rate)
+    geocode_rate.admin_order_field = 'success_rate'
+
+admin.site.register(GeocodeStats, GeocodeStatsAdmin)
+
+
+class GeocodeFailureStatsAdmin(admin.ModelAdmin):
+    list_display = ('date', 'scraper', 'name', 'count')
+    list_filter = ('scraper', 'name')
+    date_hierarchy = 'date'
+    ordering = ('-date', 'scraper', '-count')
+
+admin.site.register(GeocodeFailureStats, GeocodeFailureStatsAdmin)
+
+
 class GeocodeAdmin(admin.ModelAdmin):
     list_display = ('id', 'batch', 'date', 'success', 'location', 'name',
                     'zipcode')
@@ -30,14 +78,46 @@ class GeocodeAdmin(admin.ModelAdmin):
     search_fields = ('batch__id', 'location', 'description')
     ordering = ('-date',)
     readonly_fields = ('success', 'name', 'batch', 'news_item', 'scraper',
-                       'zipcode')
+                       'zipcode', 'traceback_text', 'geocoder_hit_rate')
+    fieldsets = (
+        (None, {'fields': ('location', 'zipcode', 'success', 'name',
+                           'batch', 'news_item', 'scraper', 'description')}),
+        ('Traceback', {'classes': ('collapse',),
+                       'fields': ('traceback_text',)}),
+        ('Geocoder', {'classes': ('collapse',),
+                      'fields': ('geocoder_hit_rate',)}),
+    )
     form = GeocodeForm
+    actions = ['regeocode_selected']
     formfield_overrides = {
         models.CharField: {'widget': GoogleMapsLink},
     }
+
+    def traceback_text(self, obj):
+        if obj.traceback_id is None:
+            return ''
+        return mark_safe('<pre>{0}</pre>'.format(escape(obj.traceback.text)))
+    traceback_text.short_description = 'Traceback'
+
+    def geocoder_hit_rate(self, obj):
+        geocoder = get_shared_geocoder()
+        return '{0:.2%} of {1} lookups answered from memory'.format(
+            geocoder.hit_rate, geocoder.hits + geocoder.misses)
+    geocoder_hit_rate.short_description = 'Geocoder hit rate'
+
+    def regeocode_selected(self, request, queryset):
+        tried, located, fixed = regeocode(queryset)
+        self.message_user(request, "Located {0} of {1} locations, fixing "
+                          "{2} geocodes. Geocoder hit rate: {3:.2%}.".format(
+                              located, tried, fixed,
+                              get_shared_geocoder().hit_rate))
+    regeocode_selected.short_description = 'Geocode selected failures again'
+
     def save_model(self, request, obj, form, change):
         obj.news_item.location = form.cleaned_data['result']['point']
         obj.news_item.save()
+        if not obj.success:
+            GeocodeStats.objects.fixed(Geocode.objects.filter(pk=obj.pk))
         obj.name = ''
         obj.success = True
         obj.save()
@@ -61,3 +141,32 @@ class MessageAdmin(admin.ModelAdmin):
         return "{0}...".format(obj.body[:100])
 
 admin.site.register(Message, MessageAdmin)
+
+
+class MessageSampleInline(admin.TabularInline):
+    model = MessageSample
+    fields = ('date', 'body')
+    readonly_fields = ('date', 'body')
+    extra = 0
+    can_delete = False
+
+
+class MessageGroupAdmin(admin.ModelAdmin):
+    list_display = ('id', 'last_seen', 'count', 'logger', 'level', 'location',
+                    'description', 'first_seen')
+    list_filter = ('logger', 'level', 'last_seen')
+    search_fields = ('template', 'logger')
+    ordering = ('-last_seen',)
+    readonly_fields = ('fingerprint', 'logger', 'level', 'template',
+                       'funcname', 'pathname', 'lineno', 'first_seen',
+                       'last_seen', 'count')
+    inlines = [MessageSampleInline]
+
+    def location(self, obj):
+        return "...{0} - {1}:{2}".format(obj.pathname[-30:], obj.funcname,
+                                         obj.lineno)
+
+    def description(self, obj):
+        return "{0}...".format(obj.template[:100])
+
+admin.site.register(MessageGroup, MessageGroupAdmin)
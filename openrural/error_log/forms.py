@@ -6,6 +6,7 @@ from django.utils.safestring import mark_safe
 from ebpub import geocoder
 
 from openrural.error_log.models import Geocode
+from openrural.retrieval.geocoders import get_shared_geocoder
 
 
 __all__ = ('GoogleMapsLink', 'GeocodeForm')
@@ -28,7 +29,7 @@ class GeocodeForm(forms.ModelForm):
 
     def clean_location(self):
         location = self.cleaned_data['location']
-        smart_geocoder = geocoder.SmartGeocoder()
+        smart_geocoder = get_shared_geocoder()
         try:
             self.cleaned_data['result'] = smart_geocoder.geocode(location)
         except geocoder.InvalidBlockButValidStreet, e:
@@ -1,7 +1,17 @@
+import os
+import re
+import Queue
+import hashlib
 import logging
+import datetime
+import threading
 
 
-__all__ = ('DatabaseHandler', )
+__all__ = ('DatabaseHandler', 'QueuedDatabaseHandler',
+           'AggregatingDatabaseHandler')
+
+
+logger = logging.getLogger('openrural.error_log')
 
 
 class DatabaseHandler(logging.Handler):
@@ -10,5 +20,234 @@ class DatabaseHandler(logging.Handler):
     def emit(self, record):
         from openrural.error_log.models import Message
         Message.objects.create(logger=record.name, level=record.levelname,
-                               body=record.msg, funcname=record.funcName,
+                               body=record.getMessage(), funcname=record.funcName,
                                pathname=record.pathname, lineno=record.lineno)
+
+
+class QueuedDatabaseHandler(logging.Handler):
+    """
+    Like DatabaseHandler, but emit() only puts the record on a queue. A
+    background thread inserts queued messages in batches, whenever
+    ``batch_size`` records are waiting or ``interval`` milliseconds have
+    passed, in its own transaction.
+
+    When more than ``capacity`` records are waiting, new ones are dropped
+    (and counted in ``dropped``) rather than slowing down the caller. The
+    next batch written includes a warning with the number dropped since
+    the previous one, and flush() logs the total since it last ran.
+
+    Unlike other handlers, flush() stops the writer thread once the queue
+    is written; the next record starts it again. close(), which logging
+    calls at exit, writes whatever is left.
+    """
+
+    def __init__(self, level=logging.NOTSET, capacity=10000, batch_size=500,
+                 interval=1000):
+        logging.Handler.__init__(self, level)
+        self.capacity = int(capacity)
+        self.batch_size = int(batch_size)
+        self.interval = float(interval) / 1000
+        self.dropped = 0
+        self.written = 0
+        # self.dropped when it was last written to the database / flushed
+        self._dropped_written = 0
+        self._dropped_flushed = 0
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        # also called after a fork (e.g. by GeocoderPool), since the
+        # child process doesn't inherit the writer thread
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue.Queue(self.capacity)
+            self._thread = threading.Thread(target=self._run,
+                                            name='QueuedDatabaseHandler')
+            self._thread.setDaemon(True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        elif threading.currentThread() is self._thread:
+            # e.g. django.db.backends logging the inserts below
+            return
+        try:
+            self._queue.put_nowait(self.make_row(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def make_row(self, record):
+        """Returns what's queued, and later passed to write(), for record."""
+        return (datetime.datetime.fromtimestamp(record.created), record.name,
+                record.levelname, record.getMessage(), record.funcName or '',
+                record.pathname or '', record.lineno)
+
+    def _dropped_row(self):
+        """
+        Returns a row reporting the records dropped since the last one was
+        written, or None.
+        """
+        dropped = self.dropped - self._dropped_written
+        if dropped <= 0:
+            return None
+        self._dropped_written += dropped
+        record = logging.LogRecord(
+            logger.name, logging.WARNING, __file__, 0,
+            'QueuedDatabaseHandler dropped %d log records', (dropped,), None)
+        return self.make_row(record)
+
+    def _run(self):
+        rows = []
+        deadline = None
+        done = False
+        while not done:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - datetime.datetime.now(),
+                              datetime.timedelta(0))
+                timeout = timeout.seconds + timeout.microseconds / 1e6
+            try:
+                row = self._queue.get(True, timeout)
+            except Queue.Empty:
+                row = False
+            if row is None:
+                done = True
+            elif row:
+                rows.append(row)
+                if deadline is None:
+                    deadline = datetime.datetime.now() + \
+                        datetime.timedelta(seconds=self.interval)
+            if rows and (done or len(rows) >= self.batch_size or
+                         datetime.datetime.now() >= deadline) or \
+                    done and self.dropped > self._dropped_written:
+                dropped = self._dropped_row()
+                if dropped is not None:
+                    rows.append(dropped)
+                try:
+                    self.write(rows)
+                    self.written += len(rows)
+                except Exception:
+                    # there's nowhere sensible to log this to
+                    self.dropped += len(rows)
+                rows = []
+                deadline = None
+        from django.db import connection
+        connection.close()
+
+    def write(self, rows):
+        from django.db import connection, transaction
+        from django.utils.encoding import force_unicode
+        from openrural.error_log.models import Message
+        qn = connection.ops.quote_name
+        columns = ('date', 'logger', 'level', 'body', 'funcname', 'pathname',
+                   'lineno')
+        sql = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+            qn(Message._meta.db_table),
+            ', '.join([qn(Message._meta.get_field(c).column)
+                       for c in columns]),
+            ', '.join(['%s'] * len(columns)),
+        )
+        with transaction.commit_on_success():
+            cursor = connection.cursor()
+            cursor.executemany(sql, [row[:3] + (force_unicode(row[3]),) +
+                                     row[4:] for row in rows])
+
+    def flush(self):
+        """
+        Waits until everything queued so far has been written, and stops
+        the writer thread.
+        """
+        dropped = self.dropped - self._dropped_flushed
+        if dropped:
+            # queued ahead of the stop below, if there's room
+            logger.warning('QueuedDatabaseHandler dropped %d log records '
+                           'since the last flush', dropped)
+            self._dropped_flushed = self.dropped
+        if self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+            self._pid = None
+
+    def close(self):
+        self.flush()
+        logging.Handler.close(self)
+
+
+# Likely variable parts of messages logged without arguments
+VARIABLE_RE = re.compile(r"'[^']*'|\"[^\"]*\"|\b0x[0-9a-f]+\b|\d+",
+                         re.IGNORECASE)
+
+
+def message_template(record):
+    """
+    Returns the message of ``record`` with its variable parts taken out:
+    the format string when the message was logged with arguments,
+    otherwise the message with quoted strings and numbers replaced.
+    """
+    from django.utils.encoding import force_unicode
+    template = force_unicode(record.msg)
+    if not record.args:
+        template = VARIABLE_RE.sub('?', template)
+    return template
+
+
+def message_fingerprint(name, level, funcname, lineno, template):
+    parts = [name, level, funcname, unicode(lineno), template]
+    return hashlib.sha1(u'\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+class AggregatingDatabaseHandler(QueuedDatabaseHandler):
+    """
+    A QueuedDatabaseHandler storing a MessageGroup per logging call
+    (fingerprinted by logger, level, function, line and message template)
+    instead of a Message per record. Each group counts its messages and
+    keeps the first ``samples`` of them as MessageSamples.
+    """
+
+    def __init__(self, level=logging.NOTSET, samples=10, **kwargs):
+        QueuedDatabaseHandler.__init__(self, level, **kwargs)
+        self.samples = int(samples)
+
+    def make_row(self, record):
+        return QueuedDatabaseHandler.make_row(self, record) + \
+            (message_template(record),)
+
+    def write(self, rows):
+        from django.db import transaction
+        from django.db.models import F
+        from django.utils.encoding import force_unicode
+        from openrural.error_log.models import MessageGroup, MessageSample
+        groups = {}
+        for row in rows:
+            date, name, level, body, funcname, pathname, lineno, template = row
+            fingerprint = message_fingerprint(name, level, funcname, lineno,
+                                              template)
+            if fingerprint not in groups:
+                groups[fingerprint] = {
+                    'logger': name, 'level': level, 'template': template,
+                    'funcname': funcname, 'pathname': pathname,
+                    'lineno': lineno, 'first_seen': date, 'bodies': [],
+                }
+            group = groups[fingerprint]
+            group['last_seen'] = date
+            group['bodies'].append((date, force_unicode(body)))
+        with transaction.commit_on_success():
+            for fingerprint, info in groups.iteritems():
+                bodies = info.pop('bodies')
+                last_seen = info.pop('last_seen')
+                group, created = MessageGroup.objects.get_or_create(
+                    fingerprint=fingerprint,
+                    defaults=dict(info, last_seen=last_seen, count=0))
+                num_samples = group.count
+                MessageGroup.objects.filter(pk=group.pk).update(
+                    count=F('count') + len(bodies), last_seen=last_seen)
+                for date, body in bodies[:max(self.samples - num_samples, 0)]:
+                    MessageSample.objects.create(group=group, date=date,
+                                                 body=body)
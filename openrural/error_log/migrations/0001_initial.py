@@ -0,0 +1,186 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    depends_on = (
+        ("db", "0001_initial"),
+    )
+
+    def forwards(self, orm):
+        
+        # Adding model 'GeocodeBatch'
+        db.create_table('error_log_geocodebatch', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('scraper', self.gf('django.db.models.fields.CharField')(max_length=255, db_index=True)),
+            ('start_time', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, db_index=True, blank=True)),
+            ('end_time', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True, db_index=True)),
+            ('num', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('num_added', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('num_changed', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('num_skipped', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('num_geocoded', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('num_geocoded_success', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+        ))
+        db.send_create_signal('error_log', ['GeocodeBatch'])
+
+        # Adding model 'Geocode'
+        db.create_table('error_log_geocode', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('batch', self.gf('django.db.models.fields.related.ForeignKey')(related_name='geocodes', to=orm['error_log.GeocodeBatch'])),
+            ('news_item', self.gf('django.db.models.fields.related.ForeignKey')(blank=True, related_name='geocodes', null=True, to=orm['db.NewsItem'])),
+            ('date', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, db_index=True, blank=True)),
+            ('scraper', self.gf('django.db.models.fields.CharField')(max_length=255, db_index=True)),
+            ('location', self.gf('django.db.models.fields.CharField')(max_length=1024)),
+            ('zipcode', self.gf('django.db.models.fields.CharField')(max_length=16, blank=True)),
+            ('success', self.gf('django.db.models.fields.BooleanField')(default=True)),
+            ('name', self.gf('django.db.models.fields.CharField')(max_length=255, blank=True, db_index=True)),
+            ('description', self.gf('django.db.models.fields.TextField')(blank=True)),
+        ))
+        db.send_create_signal('error_log', ['Geocode'])
+
+        # Adding model 'Message'
+        db.create_table('error_log_message', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('date', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, db_index=True, blank=True)),
+            ('logger', self.gf('django.db.models.fields.CharField')(max_length=512, db_index=True)),
+            ('level', self.gf('django.db.models.fields.CharField')(max_length=16, db_index=True)),
+            ('body', self.gf('django.db.models.fields.TextField')()),
+            ('funcname', self.gf('django.db.models.fields.CharField')(max_length=512, blank=True)),
+            ('pathname', self.gf('django.db.models.fields.CharField')(max_length=2048, blank=True)),
+            ('lineno', self.gf('django.db.models.fields.PositiveIntegerField')(null=True, blank=True)),
+        ))
+        db.send_create_signal('error_log', ['Message'])
+
+
+    def backwards(self, orm):
+        
+        # Deleting model 'Geocode'
+        db.delete_table('error_log_geocode')
+
+        # Deleting model 'GeocodeBatch'
+        db.delete_table('error_log_geocodebatch')
+
+        # Deleting model 'Message'
+        db.delete_table('error_log_message')
+
+
+    models = {
+        'error_log.geocode': {
+            'Meta': {'object_name': 'Geocode'},
+            'batch': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'geocodes'", 'to': "orm['error_log.GeocodeBatch']"}),
+            'date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True', 'db_index': 'True'}),
+            'description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('django.db.models.fields.CharField', [], {'max_length': '1024'}),
+            'name': ('django.db.models.fields.CharField', [], {'blank': 'True', 'db_index': 'True', 'max_length': '255'}),
+            'news_item': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'null': 'True', 'related_name': "'geocodes'", 'to': "orm['db.NewsItem']"}),
+            'scraper': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '255'}),
+            'success': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'zipcode': ('django.db.models.fields.CharField', [], {'blank': 'True', 'max_length': '16'})
+        },
+        'error_log.geocodebatch': {
+            'Meta': {'object_name': 'GeocodeBatch'},
+            'end_time': ('django.db.models.fields.DateTimeField', [], {'blank': 'True', 'db_index': 'True', 'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'num': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'num_added': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'num_changed': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'num_geocoded': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'num_geocoded_success': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'num_skipped': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'scraper': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '255'}),
+            'start_time': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True', 'db_index': 'True'})
+        },
+        'error_log.message': {
+            'Meta': {'object_name': 'Message'},
+            'body': ('django.db.models.fields.TextField', [], {}),
+            'date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True', 'db_index': 'True'}),
+            'funcname': ('django.db.models.fields.CharField', [], {'blank': 'True', 'max_length': '512'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'level': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '16'}),
+            'lineno': ('django.db.models.fields.PositiveIntegerField', [], {'blank': 'True', 'null': 'True'}),
+            'logger': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '512'}),
+            'pathname': ('django.db.models.fields.CharField', [], {'blank': 'True', 'max_length': '2048'})
+        },
+        'db.location': {
+            'Meta': {'ordering': "('slug',)", 'unique_together': "(('slug', 'location_type'),)", 'object_name': 'Location'},
+            'area': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'city': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'creation_date': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'null': 'True', 'blank': 'True'}),
+            'description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'display_order': ('django.db.models.fields.SmallIntegerField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_public': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_mod_date': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'null': 'True', 'blank': 'True'}),
+            'location': ('django.contrib.gis.db.models.fields.GeometryField', [], {'null': 'True'}),
+            'location_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.LocationType']"}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'normalized_name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'population': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '32', 'db_index': 'True'}),
+            'source': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'user_id': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'db.locationtype': {
+            'Meta': {'ordering': "('name',)", 'object_name': 'LocationType'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_browsable': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_significant': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'plural_name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'scope': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '32', 'db_index': 'True'})
+        },
+        'db.newsitem': {
+            'Meta': {'ordering': "('title',)", 'object_name': 'NewsItem'},
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'item_date': ('django.db.models.fields.DateField', [], {'default': 'datetime.date.today', 'db_index': 'True'}),
+            'last_modification': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'location': ('django.contrib.gis.db.models.fields.GeometryField', [], {'null': 'True', 'blank': 'True'}),
+            'location_name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'location_object': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.Location']", 'null': 'True', 'blank': 'True'}),
+            'pub_date': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'db_index': 'True'}),
+            'schema': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['db.Schema']"}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'url': ('django.db.models.fields.TextField', [], {'blank': 'True'})
+        },
+        'db.schema': {
+            'Meta': {'ordering': "('name',)", 'object_name': 'Schema'},
+            'allow_charting': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'allow_comments': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'can_collapse': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'date_name': ('django.db.models.fields.CharField', [], {'default': "'Date'", 'max_length': '32'}),
+            'date_name_plural': ('django.db.models.fields.CharField', [], {'default': "'Dates'", 'max_length': '32'}),
+            'grab_bag': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'grab_bag_headline': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '128', 'blank': 'True'}),
+            'has_newsitem_detail': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'importance': ('django.db.models.fields.SmallIntegerField', [], {'default': '0'}),
+            'indefinite_article': ('django.db.models.fields.CharField', [], {'max_length': '2'}),
+            'intro': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'is_event': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_public': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'db_index': 'True'}),
+            'is_special_report': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_updated': ('django.db.models.fields.DateField', [], {}),
+            'map_color': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'map_icon_url': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'min_date': ('django.db.models.fields.DateField', [], {'default': 'datetime.date(1970, 1, 1)'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'number_in_overview': ('django.db.models.fields.SmallIntegerField', [], {'default': '5'}),
+            'plural_name': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'short_description': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'short_source': ('django.db.models.fields.CharField', [], {'default': "'One-line description of where this information came from.'", 'max_length': '128', 'blank': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '32', 'db_index': 'True'}),
+            'source': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'summary': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'update_frequency': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '64', 'blank': 'True'}),
+            'uses_attributes_in_list': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        }
+    }
+
+    complete_apps = ['error_log']
@@ -1,4 +1,7 @@
+import hashlib
+
 from django.db import models
+from django.utils.encoding import smart_str
 
 from ebpub.db.models import NewsItem
 
@@ -13,6 +16,13 @@ class GeocodeBatch(models.Model):
     num_skipped = models.PositiveIntegerField(default=0)
     num_geocoded = models.PositiveIntegerField(default=0)
     num_geocoded_success = models.PositiveIntegerField(default=0)
+    num_cache_hits = models.PositiveIntegerField(default=0)
+    num_cache_misses = models.PositiveIntegerField(default=0)
+    # geocodes answered from earlier rows of the same run
+    num_memo_hits = models.PositiveIntegerField(default=0)
+    # JSON-encoded keyset value of the last row saved by this batch, used
+    # as the starting point of the scraper's next incremental run.
+    high_water = models.CharField(max_length=255, blank=True)
 
     class Meta(object):
         verbose_name_plural = 'Geocode Batches'
@@ -21,6 +31,63 @@ class GeocodeBatch(models.Model):
         return "{0} ({1})".format(self.scraper, self.id)
 
 
+def split_traceback(text):
+    """
+    Splits a formatted traceback into its stack, which tends to repeat, and
+    the final exception line(s), which name the failing location.
+    """
+    lines = text.rstrip('\n').split('\n')
+    last_frame = 0
+    for i, line in enumerate(lines):
+        if line.startswith('  '):
+            last_frame = i + 1
+    return '\n'.join(lines[:last_frame]), '\n'.join(lines[last_frame:])
+
+
+class TracebackManager(models.Manager):
+
+    # digests remembered per process
+    cache_size = 1000
+
+    def __init__(self):
+        super(TracebackManager, self).__init__()
+        self._ids = {}
+
+    def for_text(self, text):
+        """
+        Returns the id of the Traceback with this text, creating it if
+        needed.
+        """
+        digest = hashlib.sha1(smart_str(text)).hexdigest()
+        pk = self._ids.get(digest)
+        if pk is None:
+            traceback, created = self.get_or_create(digest=digest,
+                                                    defaults={'text': text})
+            if len(self._ids) >= self.cache_size:
+                self._ids.clear()
+            pk = self._ids[digest] = traceback.pk
+        return pk
+
+    def forget(self):
+        """
+        Empties the per-process cache, e.g. after a write failed because a
+        cached Traceback has been pruned since.
+        """
+        self._ids.clear()
+
+
+class Traceback(models.Model):
+    """A stack trace, stored once however many Geocodes failed with it."""
+    digest = models.CharField(max_length=40, unique=True)
+    text = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = TracebackManager()
+
+    def __unicode__(self):
+        return self.digest
+
+
 class Geocode(models.Model):
     batch = models.ForeignKey(GeocodeBatch, related_name='geocodes')
     news_item = models.ForeignKey(NewsItem, related_name='geocodes', null=True,
@@ -31,7 +98,10 @@ class Geocode(models.Model):
     zipcode = models.CharField(max_length=16, blank=True)
     success = models.BooleanField(default=True)
     name = models.CharField(max_length=255, blank=True, db_index=True)
+    # the exception raised; its stack is in traceback
     description = models.TextField(blank=True)
+    traceback = models.ForeignKey(Traceback, related_name='geocodes',
+                                  null=True, blank=True)
 
     def __unicode__(self):
         if self.name:
@@ -40,6 +110,93 @@ class Geocode(models.Model):
             return self.location
 
 
+class GeocodeStatsManager(models.Manager):
+
+    def add(self, batch, failures):
+        """
+        Adds the counts of a finished GeocodeBatch to the rollups of its
+        scraper and day; ``failures`` maps exception names to the number of
+        geocodes that failed with them.
+        """
+        date = batch.start_time.date()
+        _increment(self.model, {'scraper': batch.scraper, 'date': date},
+                   num_geocoded=batch.num_geocoded,
+                   num_geocoded_success=batch.num_geocoded_success,
+                   num_batches=1)
+        for name, count in failures.iteritems():
+            _increment(GeocodeFailureStats,
+                       {'scraper': batch.scraper, 'date': date, 'name': name},
+                       count=count)
+
+    def fixed(self, geocodes):
+        """
+        Counts the failed Geocodes of the ``geocodes`` queryset, which are
+        about to be marked successful, as successes of their batches and of
+        the rollups of their day, and takes them off the failure rollups.
+        """
+        batches = {}
+        days = {}
+        rows = geocodes.filter(success=False).values_list(
+            'batch', 'batch__scraper', 'batch__start_time', 'name')
+        for batch_id, scraper, start_time, name in rows:
+            batches[batch_id] = batches.get(batch_id, 0) + 1
+            key = (scraper, start_time.date(), name)
+            days[key] = days.get(key, 0) + 1
+        for batch_id, count in batches.iteritems():
+            GeocodeBatch.objects.filter(pk=batch_id).update(
+                num_geocoded_success=models.F('num_geocoded_success') + count)
+        for (scraper, date, name), count in days.iteritems():
+            self.filter(scraper=scraper, date=date).update(
+                num_geocoded_success=models.F('num_geocoded_success') + count)
+            GeocodeFailureStats.objects.filter(
+                scraper=scraper, date=date, name=name,
+                count__gte=count).update(count=models.F('count') - count)
+
+
+def _increment(model, key, **counts):
+    """Adds ``counts`` to the row of ``model`` with ``key``, or creates it."""
+    updates = dict([(field, models.F(field) + value)
+                    for field, value in counts.iteritems()])
+    if not model.objects.filter(**key).update(**updates):
+        obj, created = model.objects.get_or_create(defaults=counts, **key)
+        if not created:
+            # someone else created it first
+            model.objects.filter(**key).update(**updates)
+
+
+class GeocodeStats(models.Model):
+    """Geocoding counts of a scraper's batches started on the same day."""
+    scraper = models.CharField(max_length=255, db_index=True)
+    date = models.DateField(db_index=True)
+    num_batches = models.PositiveIntegerField(default=0)
+    num_geocoded = models.PositiveIntegerField(default=0)
+    num_geocoded_success = models.PositiveIntegerField(default=0)
+
+    objects = GeocodeStatsManager()
+
+    class Meta(object):
+        unique_together = (('scraper', 'date'),)
+        verbose_name_plural = 'Geocode Stats'
+
+    def __unicode__(self):
+        return "{0} ({1})".format(self.scraper, self.date)
+
+
+class GeocodeFailureStats(models.Model):
+    """Geocodes of a scraper that failed with the same exception, per day."""
+    scraper = models.CharField(max_length=255, db_index=True)
+    date = models.DateField(db_index=True)
+    name = models.CharField(max_length=255, db_index=True)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta(object):
+        unique_together = (('scraper', 'date', 'name'),)
+        verbose_name_plural = 'Geocode Failure Stats'
+
+    def __unicode__(self):
+        return "{0} ({1}): {2}".format(self.scraper, self.date, self.name)
+
+
 # class MessageBatch(models.Model):
 #     start_time = models.DateTimeField(auto_now_add=True, db_index=True)
 
@@ -59,3 +216,30 @@ class Message(models.Model):
     funcname = models.CharField("Function", max_length=512, blank=True)
     pathname = models.CharField("Path", max_length=2048, blank=True)
     lineno = models.PositiveIntegerField("Line", null=True, blank=True)
+
+
+class MessageGroup(models.Model):
+    """
+    Log messages from the same logging call, aggregated (see
+    logger.AggregatingDatabaseHandler).
+    """
+    fingerprint = models.CharField(max_length=40, unique=True)
+    logger = models.CharField(max_length=512, db_index=True)
+    level = models.CharField(max_length=16, db_index=True)
+    template = models.TextField()
+    funcname = models.CharField("Function", max_length=512, blank=True)
+    pathname = models.CharField("Path", max_length=2048, blank=True)
+    lineno = models.PositiveIntegerField("Line", null=True, blank=True)
+    first_seen = models.DateTimeField(db_index=True)
+    last_seen = models.DateTimeField(db_index=True)
+    count = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return u"{0}: {1}".format(self.logger, self.template[:100])
+
+
+class MessageSample(models.Model):
+    """One of the first few messages of a MessageGroup, as logged."""
+    group = models.ForeignKey(MessageGroup, related_name='samples')
+    date = models.DateTimeField(db_index=True)
+    body = models.TextField()
@@ -0,0 +1,89 @@
+"""
+Retrying failed geocodes in bulk, e.g. after importing new streets.
+"""
+
+from django.db import transaction
+
+from ebpub.db.models import NewsItem
+from ebpub.geocoder import AmbiguousResult
+
+from openrural.error_log.models import GeocodeStats
+from openrural.retrieval.geocoders import GEOCODE_ERRORS, GeocodeMemo, \
+    GeocoderPool, get_shared_geocoder
+
+
+__all__ = ('regeocode', )
+
+
+def _resolve(result, error, zipcode):
+    """
+    Returns the point of a geocoding outcome, settling ambiguous results
+    by zipcode the way ScraperWikiScraper.geocode() does, or None.
+    """
+    if error is None:
+        return result['point']
+    if isinstance(error, AmbiguousResult) and zipcode:
+        in_zip = [r for r in error.choices if r['zip'] == zipcode]
+        if in_zip:
+            return in_zip[0]['point']
+    return None
+
+
+def regeocode(geocodes, processes=1, chunk_size=500, progress=None):
+    """
+    Geocodes the distinct locations of the failed Geocodes in the
+    ``geocodes`` queryset again, on ``processes`` worker processes. The
+    NewsItems of those that now succeed get the new point, and their
+    Geocodes are marked successful, one transaction per ``chunk_size``
+    locations.
+
+    ``progress``, if given, is called after each chunk with the number of
+    locations done, the total and the number of Geocodes fixed so far.
+    Returns (locations tried, locations fixed, Geocodes fixed).
+    """
+    geocodes = geocodes.filter(success=False)
+    # without order_by(), DISTINCT would also include the ordering columns
+    pairs = list(geocodes.order_by().values_list('location', 'zipcode')
+                 .distinct())
+    geocoder = get_shared_geocoder()
+    memo = GeocodeMemo(geocoder)
+    pool = None
+    if processes > 1:
+        pool = GeocoderPool(processes, type(geocoder))
+    num_locations = num_geocodes = 0
+    try:
+        for start in xrange(0, len(pairs), chunk_size):
+            chunk = pairs[start:start + chunk_size]
+            if pool is not None:
+                # the zipcode only settles ambiguous results, below
+                memo.prefetch([(location, None) for location, z in chunk],
+                              pool)
+            points = []
+            for location, zipcode in chunk:
+                try:
+                    result, error = memo.geocode(location), None
+                except GEOCODE_ERRORS, e:
+                    result, error = None, e
+                point = _resolve(result, error, zipcode)
+                if point is not None:
+                    points.append((location, zipcode, point))
+            with transaction.commit_on_success():
+                for location, zipcode, point in points:
+                    rows = geocodes.filter(location=location, zipcode=zipcode)
+                    ids = list(rows.values_list('id', 'news_item'))
+                    news_item_ids = [n for i, n in ids if n is not None]
+                    NewsItem.objects.filter(pk__in=news_item_ids).update(
+                        location=point)
+                    fixed = geocodes.model.objects.filter(
+                        pk__in=[i for i, n in ids])
+                    GeocodeStats.objects.fixed(fixed)
+                    fixed.update(success=True, name='', description='',
+                                 traceback=None)
+                    num_geocodes += len(ids)
+            num_locations += len(points)
+            if progress is not None:
+                progress(start + len(chunk), len(pairs), num_geocodes)
+    finally:
+        if pool is not None:
+            pool.close()
+    return len(pairs), num_locations, num_geocodes
@@ -0,0 +1,319 @@
+"""
+Expiry of old error_log rows, configured with ERROR_LOG_RETENTION.
+
+ERROR_LOG_RETENTION maps model names to the number of days their rows are
+kept, either for the whole table or per scraper (for Geocode and
+GeocodeBatch) or per logger (for Message and MessageGroup), with 'default'
+covering everything else::
+
+    ERROR_LOG_RETENTION = {
+        'Geocode': {'default': 90, 'chpd-police': 365},
+        'GeocodeBatch': 365,
+        'Message': 30,
+        'MessageGroup': 90,
+    }
+
+Models left out, or with a retention of None, are kept forever.
+
+Geocode and Message can also be split into monthly child tables
+(PostgreSQL table inheritance), so that a month past its retention is
+dropped with one DROP TABLE instead of row by row. Each child table gets
+the primary key, foreign keys and indexes of its parent, which INHERITS
+doesn't copy; unique constraints only hold within a month.
+"""
+
+import re
+import time
+import datetime
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from openrural.error_log.models import Geocode, GeocodeBatch, Message, \
+    MessageGroup, MessageSample, Traceback
+
+
+__all__ = ('DEFAULT_RETENTION', 'get_retention', 'prune', 'partition',
+           'drop_partitions', 'PARTITIONED_MODELS')
+
+
+DEFAULT_RETENTION = {
+    'Geocode': 90,
+    'GeocodeBatch': 365,
+    'Message': 30,
+    'MessageGroup': 90,
+}
+
+# model: (date column, column the retention can be keyed on)
+PRUNED_MODELS = (
+    (Geocode, 'date', 'scraper'),
+    (Message, 'date', 'logger'),
+    (MessageGroup, 'last_seen', 'logger'),
+    (GeocodeBatch, 'start_time', 'scraper'),
+)
+
+PARTITIONED_MODELS = (Geocode, Message)
+
+
+def get_retention(model):
+    """
+    Returns a dictionary of {scraper or logger: days} for ``model``, with
+    the 'default' key applying to all others.
+    """
+    retention = getattr(settings, 'ERROR_LOG_RETENTION', DEFAULT_RETENTION)
+    days = retention.get(model.__name__)
+    if not isinstance(days, dict):
+        days = {'default': days}
+    return days
+
+
+def _delete_chunked(table, where, params, chunk_size, pause):
+    """
+    Deletes the rows of ``table`` matching ``where`` at most ``chunk_size``
+    at a time, committing after each chunk so locks are held briefly.
+    Returns the number of rows deleted.
+    """
+    qn = connection.ops.quote_name
+    sql = ('DELETE FROM {0} WHERE id IN '
+           '(SELECT id FROM {0} WHERE {1} LIMIT {2})').format(
+               qn(table), where, int(chunk_size))
+    total = 0
+    while True:
+        with transaction.commit_on_success():
+            cursor = connection.cursor()
+            cursor.execute(sql, params)
+            deleted = cursor.rowcount
+        total += deleted
+        if deleted < chunk_size:
+            return total
+        if pause:
+            time.sleep(pause)
+
+
+def _move_chunked(table, child, where, params, chunk_size, pause):
+    """
+    Moves the rows of ``table`` (but not its children) matching ``where``
+    into ``child``, at most ``chunk_size`` at a time in id order, committing
+    after each chunk like _delete_chunked(). Returns the number of rows
+    moved.
+    """
+    qn = connection.ops.quote_name
+    select = ('SELECT id FROM ONLY {0} WHERE {1} ORDER BY id LIMIT {2} '
+              'FOR UPDATE').format(qn(table), where, int(chunk_size))
+    bounded = '{0} AND id >= %s AND id <= %s'.format(where)
+    total = 0
+    while True:
+        with transaction.commit_on_success():
+            cursor = connection.cursor()
+            cursor.execute(select, params)
+            ids = [row[0] for row in cursor.fetchall()]
+            if ids:
+                bounds = params + [ids[0], ids[-1]]
+                cursor.execute('INSERT INTO {0} SELECT * FROM ONLY {1} '
+                               'WHERE {2}'.format(qn(child), qn(table),
+                                                  bounded), bounds)
+                cursor.execute('DELETE FROM ONLY {0} WHERE {1}'.format(
+                    qn(table), bounded), bounds)
+        total += len(ids)
+        if len(ids) < chunk_size:
+            return total
+        if pause:
+            time.sleep(pause)
+
+
+def prune(now=None, chunk_size=1000, pause=0, dry_run=False):
+    """
+    Deletes rows past their retention. Yields (model name, key, cutoff,
+    number of rows) for each retention rule applied.
+    """
+    now = now or datetime.datetime.now()
+    qn = connection.ops.quote_name
+    for model, date_column, key_column in PRUNED_MODELS:
+        days = get_retention(model)
+        keys = [key for key in days if key != 'default']
+        table = model._meta.db_table
+        for key, value in days.iteritems():
+            if value is None:
+                continue
+            cutoff = now - datetime.timedelta(days=value)
+            where = ['{0} < %s'.format(qn(date_column))]
+            params = [cutoff]
+            if key != 'default':
+                where.append('{0} = %s'.format(qn(key_column)))
+                params.append(key)
+            elif keys:
+                where.append('{0} NOT IN ({1})'.format(
+                    qn(key_column), ', '.join(['%s'] * len(keys))))
+                params.extend(keys)
+            if model is MessageGroup:
+                # samples first, they reference the groups
+                sample_where = '{0} IN (SELECT id FROM {1} WHERE {2})'.format(
+                    qn('group_id'), qn(table), ' AND '.join(where))
+                if not dry_run:
+                    _delete_chunked(MessageSample._meta.db_table,
+                                    sample_where, params, chunk_size, pause)
+            if model is GeocodeBatch:
+                # batches still referenced by a Geocode are kept
+                where.append('NOT EXISTS (SELECT 1 FROM {0} WHERE {1} = '
+                             '{2}.id)'.format(qn(Geocode._meta.db_table),
+                                              qn('batch_id'), qn(table)))
+            where = ' AND '.join(where)
+            if dry_run:
+                cursor = connection.cursor()
+                cursor.execute('SELECT COUNT(*) FROM {0} WHERE {1}'.format(
+                    qn(table), where), params)
+                count = cursor.fetchone()[0]
+            else:
+                count = _delete_chunked(table, where, params, chunk_size,
+                                        pause)
+            yield model.__name__, key, cutoff, count
+    # Tracebacks no longer referenced. Recent ones may belong to Geocodes
+    # a running scraper hasn't written yet.
+    cutoff = now - datetime.timedelta(days=1)
+    table = Traceback._meta.db_table
+    where = ('{0} < %s AND NOT EXISTS (SELECT 1 FROM {1} WHERE {2} = '
+             '{3}.id)').format(qn('created'), qn(Geocode._meta.db_table),
+                               qn('traceback_id'), qn(table))
+    if dry_run:
+        cursor = connection.cursor()
+        cursor.execute('SELECT COUNT(*) FROM {0} WHERE {1}'.format(
+            qn(table), where), [cutoff])
+        count = cursor.fetchone()[0]
+    else:
+        count = _delete_chunked(table, where, [cutoff], chunk_size, pause)
+    yield Traceback.__name__, 'unused', cutoff, count
+
+
+def _month_start(date):
+    return datetime.datetime(date.year, date.month, 1)
+
+
+def _next_month(date):
+    if date.month == 12:
+        return datetime.datetime(date.year + 1, 1, 1)
+    return datetime.datetime(date.year, date.month + 1, 1)
+
+
+def partition_name(model, month):
+    return '{0}_y{1:04d}m{2:02d}'.format(model._meta.db_table, month.year,
+                                         month.month)
+
+
+def _partition_month(model, name):
+    """
+    Returns the first day of the month held by the child table ``name`` of
+    ``model``, or None if ``name`` isn't one of its monthly partitions.
+    """
+    match = re.match(r'^{0}_y(\d{{4}})m(\d{{2}})$'.format(
+        re.escape(model._meta.db_table)), name)
+    if match is None:
+        return None
+    return datetime.datetime(int(match.group(1)), int(match.group(2)), 1)
+
+
+def _add_constraints(cursor, model, child):
+    """
+    Gives the child table ``child`` the primary key, foreign keys, unique
+    constraints and indexes of ``model``'s table, none of which INHERITS
+    copies. Unique constraints only hold within the child.
+    """
+    qn = connection.ops.quote_name
+    cursor.execute('ALTER TABLE {0} ADD PRIMARY KEY (id)'.format(qn(child)))
+    for field in model._meta.local_fields:
+        if field.primary_key:
+            continue
+        if field.rel is not None:
+            target = field.rel.to
+            cursor.execute(
+                'ALTER TABLE {0} ADD CONSTRAINT {1} FOREIGN KEY ({2}) '
+                'REFERENCES {3} ({4}) DEFERRABLE INITIALLY DEFERRED'.format(
+                    qn(child), qn('{0}_{1}_fkey'.format(child, field.column)),
+                    qn(field.column), qn(target._meta.db_table),
+                    qn(target._meta.pk.column)))
+        if field.unique:
+            cursor.execute('ALTER TABLE {0} ADD UNIQUE ({1})'.format(
+                qn(child), qn(field.column)))
+        elif field.db_index:
+            cursor.execute('CREATE INDEX {0} ON {1} ({2})'.format(
+                qn('{0}_{1}'.format(child, field.column)), qn(child),
+                qn(field.column)))
+    for fields in model._meta.unique_together:
+        columns = [model._meta.get_field(name).column for name in fields]
+        cursor.execute('ALTER TABLE {0} ADD UNIQUE ({1})'.format(
+            qn(child), ', '.join([qn(column) for column in columns])))
+
+
+def _partitions(model):
+    """Returns the names of ``model``'s monthly child tables."""
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT c.relname FROM pg_inherits i '
+        'JOIN pg_class c ON c.oid = i.inhrelid '
+        'JOIN pg_class p ON p.oid = i.inhparent '
+        'WHERE p.relname = %s ORDER BY c.relname',
+        [model._meta.db_table])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def partition(model, now=None, chunk_size=1000, pause=0):
+    """
+    Moves the rows of every finished month still in ``model``'s own table
+    into a child table for that month, creating it if needed, in chunks of
+    ``chunk_size`` rows. Queries on the parent table still see them.
+    Returns the names of the child tables written to.
+    """
+    now = now or datetime.datetime.now()
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    date_column = model._meta.get_field('date').column
+    current = _month_start(now)
+    cursor = connection.cursor()
+    cursor.execute('SELECT MIN({0}) FROM ONLY {1} WHERE {0} < %s'.format(
+        qn(date_column), qn(table)), [current])
+    oldest = cursor.fetchone()[0]
+    existing = set(_partitions(model))
+    written = []
+    month = oldest and _month_start(oldest)
+    while month and month < current:
+        end = _next_month(month)
+        child = partition_name(model, month)
+        if child not in existing:
+            with transaction.commit_on_success():
+                cursor = connection.cursor()
+                cursor.execute(
+                    'CREATE TABLE {0} (CHECK ({1} >= %s AND {1} < %s)) '
+                    'INHERITS ({2})'.format(qn(child), qn(date_column),
+                                            qn(table)), [month, end])
+                _add_constraints(cursor, model, child)
+        where = '{0} >= %s AND {0} < %s'.format(qn(date_column))
+        if _move_chunked(table, child, where, [month, end], chunk_size,
+                         pause):
+            written.append(child)
+        month = end
+    return written
+
+
+def drop_partitions(model, now=None, dry_run=False):
+    """
+    Drops the child tables of ``model`` whose whole month is past the
+    longest retention configured for it. Returns their names.
+    """
+    now = now or datetime.datetime.now()
+    retention = get_retention(model)
+    days = retention.values()
+    # without a default, rows of unlisted scrapers are kept forever
+    if retention.get('default') is None or None in days:
+        return []
+    cutoff = now - datetime.timedelta(days=max(days))
+    dropped = []
+    for child in _partitions(model):
+        month = _partition_month(model, child)
+        if month is None:
+            continue
+        if _next_month(month) <= cutoff:
+            if not dry_run:
+                with transaction.commit_on_success():
+                    connection.cursor().execute('DROP TABLE {0}'.format(
+                        connection.ops.quote_name(child)))
+            dropped.append(child)
+    return dropped
@@ -0,0 +1,46 @@
+import json
+import datetime
+
+from django.http import HttpResponse
+from django.contrib.admin.views.decorators import staff_member_required
+
+from openrural.error_log.models import GeocodeStats, GeocodeFailureStats
+
+
+__all__ = ('geocode_stats', )
+
+
+@staff_member_required
+def geocode_stats(request):
+    """
+    Geocoding success per scraper and day over the last ``days`` days
+    (default 30), as JSON, read from the GeocodeStats rollups only.
+    """
+    try:
+        days = int(request.GET.get('days', 30))
+    except ValueError:
+        days = 30
+    since = datetime.date.today() - datetime.timedelta(days=days)
+    stats = GeocodeStats.objects.filter(date__gte=since)
+    failures = GeocodeFailureStats.objects.filter(date__gte=since)
+    if request.GET.get('scraper'):
+        stats = stats.filter(scraper=request.GET['scraper'])
+        failures = failures.filter(scraper=request.GET['scraper'])
+    scrapers = {}
+    for row in stats.order_by('date'):
+        scraper = scrapers.setdefault(row.scraper, {'days': [],
+                                                    'failures': {}})
+        scraper['days'].append({
+            'date': row.date.isoformat(),
+            'batches': row.num_batches,
+            'geocoded': row.num_geocoded,
+            'succeeded': row.num_geocoded_success,
+            'failed': row.num_geocoded - row.num_geocoded_success,
+        })
+    for row in failures:
+        scraper = scrapers.setdefault(row.scraper, {'days': [],
+                                                    'failures': {}})
+        scraper['failures'][row.name] = \
+            scraper['failures'].get(row.name, 0) + row.count
+    data = {'since': since.isoformat(), 'scrapers': scrapers}
+    return HttpResponse(json.dumps(data), mimetype='application/json')
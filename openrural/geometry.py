@@ -0,0 +1,48 @@
+"""
+Reprojection of shapefile layers for the importers.
+
+``feature.geom.transform(4326, True)`` builds a new coordinate
+transformation and clones the geometry for every feature. A
+LayerTransformer builds one CoordTransform per source spatial reference
+and transforms each feature's geometry in place; OGR transforms all the
+coordinates of a geometry in one call.
+"""
+
+from django.contrib.gis.gdal import CoordTransform, SpatialReference
+
+
+__all__ = ('LayerTransformer', )
+
+
+class LayerTransformer(object):
+
+    def __init__(self, target=4326):
+        self.target = SpatialReference(target)
+        self._transforms = {}
+
+    def coord_transform(self, srs):
+        """Returns the (cached) CoordTransform from ``srs`` to the target."""
+        key = srs.wkt
+        if key not in self._transforms:
+            self._transforms[key] = CoordTransform(srs, self.target)
+        return self._transforms[key]
+
+    def transform(self, geom, srs=None):
+        """
+        Transforms ``geom``, an OGRGeometry, in place and returns it.
+        ``srs`` defaults to the geometry's own spatial reference.
+        """
+        geom.transform(self.coord_transform(srs or geom.srs))
+        return geom
+
+    def features(self, layer):
+        """
+        Yields (feature, transformed geometry) for the features of
+        ``layer``. Feature.geom already returns a copy, which is
+        transformed without cloning it again.
+        """
+        transform = self.coord_transform(layer.srs)
+        for feature in layer:
+            geom = feature.geom
+            geom.transform(transform)
+            yield feature, geom
@@ -0,0 +1,58 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.gis.gdal import DataSource
+from django.contrib.gis.gdal.error import OGRException
+
+from openrural.geometry import LayerTransformer
+
+
+class Command(BaseCommand):
+    args = '<shapefile> [shapefile ...]'
+    option_list = BaseCommand.option_list + (
+        make_option("-r", "--repeat", action="store", type="int",
+                    dest="repeat", default=3,
+                    help="Runs of each method; the fastest is reported"),
+    )
+    help = ('Compare reprojecting shapefile features one by one with '
+            'LayerTransformer, e.g. on the parcel and city layers')
+
+    def per_feature(self, layer):
+        for feature in layer:
+            feature.geom.transform(4326, True)
+
+    def transformer(self, layer):
+        for feature, geom in LayerTransformer().features(layer):
+            pass
+
+    def best(self, method, layer, repeat):
+        times = []
+        for i in xrange(repeat):
+            start = time.time()
+            method(layer)
+            times.append(time.time() - start)
+        return min(times)
+
+    def handle(self, *shapefiles, **options):
+        if not shapefiles:
+            raise CommandError('Please give a shapefile')
+        repeat = max(1, options['repeat'])
+        for shapefile in shapefiles:
+            try:
+                layer = DataSource(shapefile)[0]
+            except OGRException, e:
+                raise CommandError(e)
+            if layer.srs is None:
+                raise CommandError('{0} has no spatial reference (.prj '
+                                   'file)'.format(shapefile))
+            count = len(layer)
+            print '%s: %d features (%s)' % (shapefile, count, layer.srs.name)
+            baseline = self.best(self.per_feature, layer, repeat)
+            for name, seconds in (
+                    ('transform(4326, True)', baseline),
+                    ('LayerTransformer', self.best(self.transformer, layer,
+                                                   repeat))):
+                print '  %-22s %8.3fs %10.0f features/s %6.2fx' % (
+                    name, seconds, count / max(seconds, 1e-9),
+                    baseline / max(seconds, 1e-9))
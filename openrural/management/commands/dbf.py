@@ -1,41 +1,189 @@
+import os
+import mmap
 import pprint
+import struct
 from optparse import make_option
-from collections import defaultdict
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from ebdata.parsing import dbf
+from openrural.dbfcache import DBF, ColumnarTable, normalize_key
+
+
+# Sidecar index: a header, then (key, record number) entries sorted by key,
+# each key normalized (see normalize_key()) and padded to the width given
+# in the header.
+INDEX_MAGIC = 'DBFX'
+INDEX_HEADER = '<4sHQdH'
+INDEX_VERSION = 2
+
+
+class Index(object):
+    """A sidecar index of one field of a DBF, searched in place."""
+
+    def __init__(self, path, dbf, field):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        header_size = struct.calcsize(INDEX_HEADER)
+        if len(self.map) < header_size:
+            raise CommandError('{0} is not a dbf index'.format(path))
+        magic, version, dbf_size, dbf_mtime, size = \
+            struct.unpack(INDEX_HEADER, self.map[:header_size])
+        stat = os.stat(dbf.path)
+        if magic != INDEX_MAGIC:
+            raise CommandError('{0} is not a dbf index'.format(path))
+        if version != INDEX_VERSION or \
+                (dbf_size, dbf_mtime) != (stat.st_size, stat.st_mtime):
+            raise CommandError('{0} is out of date, rebuild it with '
+                               '--build-index'.format(path))
+        self.field = field
+        self.start = header_size
+        self.size = size
+        self.entry_size = size + 4
+        self.count = (len(self.map) - header_size) // self.entry_size
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def _key(self, i):
+        start = self.start + i * self.entry_size
+        return self.map[start:start + self.size]
+
+    def lookup(self, key):
+        """Returns the record numbers with this key."""
+        key = normalize_key(self.field, key)
+        if len(key) > self.size:
+            return []
+        key = key.ljust(self.size, '\0')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        recnos = []
+        while lo < self.count and self._key(lo) == key:
+            start = self.start + lo * self.entry_size + self.size
+            recnos.append(struct.unpack('<L', self.map[start:start + 4])[0])
+            lo += 1
+        return recnos
+
+    @staticmethod
+    def build(path, dbf, field):
+        keys = [(normalize_key(field, key), recno)
+                for key, recno in dbf.keys(field)]
+        # normalizing can lengthen a key, e.g. '-.5' to '-0.5'
+        size = max([field[3]] + [len(key) for key, recno in keys])
+        entries = sorted([(key.ljust(size, '\0'), recno)
+                          for key, recno in keys])
+        stat = os.stat(dbf.path)
+        with open(path, 'wb') as f:
+            f.write(struct.pack(INDEX_HEADER, INDEX_MAGIC, INDEX_VERSION,
+                                stat.st_size, stat.st_mtime, size))
+            for key, recno in entries:
+                f.write(key)
+                f.write(struct.pack('<L', recno))
+        return len(entries)
 
 
 class Command(BaseCommand):
+    args = '<dbf file> [needle ...]'
     option_list = BaseCommand.option_list + (
         make_option("-g", "--group", action="store", type="string",
                     dest="group"),
         make_option("-f", "--field", action="store", type="string",
                     dest="field", default='TLID'),
+        make_option("-u", "--unique", action="store_true", dest="unique",
+                    default=False,
+                    help="Field values are unique: stop reading once every "
+                         "needle has been found"),
+        make_option("--build-index", action="store_true", dest="build_index",
+                    default=False,
+                    help="Write an index of --field next to the dbf file, "
+                         "used by later lookups"),
+        make_option("-c", "--columnar", action="store_true", dest="columnar",
+                    default=False,
+                    help="Look up in the file's columnar cache, creating it "
+                         "if needed (requires NumPy)"),
     )
     help = 'Inspect .dbf files'
 
     def handle(self, *args, **options):
-        dbf_file = args[0]
-        needle = args[1]
+        if not args:
+            raise CommandError('Please give a dbf file')
+        dbf_file, needles = args[0], args[1:]
+        if options['columnar']:
+            return self.lookup_columnar(dbf_file, needles, options)
+        dbf = DBF(dbf_file)
+        try:
+            try:
+                field = dbf.field(options['field'])
+            except ValueError, e:
+                raise CommandError(e)
+            index_file = '{0}.{1}.idx'.format(dbf_file, options['field'])
+            if options['build_index']:
+                count = Index.build(index_file, dbf, field)
+                print "Indexed %d records in %s" % (count, index_file)
+            if os.path.exists(index_file):
+                index = Index(index_file, dbf, field)
+                try:
+                    found = dict([(needle, index.lookup(needle))
+                                  for needle in needles])
+                finally:
+                    index.close()
+            else:
+                found = self.scan(dbf, field, needles, options['unique'])
+            for needle in needles:
+                if not found[needle]:
+                    continue
+                rows = [dbf.record(recno) for recno in found[needle]]
+                if len(needles) > 1:
+                    print '%s:' % needle
+                pprint.pprint(self.group(rows, options))
+        finally:
+            dbf.close()
+
+    def scan(self, dbf, field, needles, unique):
+        """
+        Reads the key field of each record, returning the record numbers
+        matching each needle. Numeric keys match by value.
+        """
+        # {normalized key: record numbers}, shared by needles like '7'
+        # and '007'
+        wanted = {}
+        found = {}
+        for needle in needles:
+            found[needle] = wanted.setdefault(normalize_key(field, needle),
+                                              [])
+        remaining = len(wanted)
+        for key, recno in dbf.keys(field):
+            recnos = wanted.get(normalize_key(field, key))
+            if recnos is not None:
+                if unique and not recnos:
+                    remaining -= 1
+                recnos.append(recno)
+                if unique and not remaining:
+                    break
+        return found
+
+    def lookup_columnar(self, dbf_file, needles, options):
+        field = options['field']
         try:
-            needle = int(needle)
-        except:
-            pass
-        db = self.load_db(dbf_file, options)
-        if needle in db:
-            pprint.pprint(db[needle])
-
-    def load_db(self, dbf_file, options):
+            table = ColumnarTable.open(dbf_file)
+            if table.kind(field) == 'int':
+                needles = [int(needle) for needle in needles]
+            groups = table.group_by(field, table.where(field, needles))
+        except (ImportError, ValueError), e:
+            raise CommandError(e)
+        for needle in needles:
+            if needle not in groups:
+                continue
+            if len(needles) > 1:
+                print '%s:' % needle
+            pprint.pprint(self.group(table.rows(groups[needle]), options))
+
+    def group(self, rows, options):
         if options['group']:
-            db = defaultdict(dict)
-        else:
-            db = defaultdict(list)
-        with open(dbf_file, 'rb') as f:
-            for row in dbf.dict_reader(f, strip_values=True):
-                if options['group']:
-                    db[row[options['field']]][row[options['group']]] = row
-                else:
-                    db[row[options['field']]].append(row)
-        return db
+            return dict([(row[options['group']], row) for row in rows])
+        return rows
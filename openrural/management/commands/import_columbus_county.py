@@ -1,6 +1,5 @@
 import os
 import datetime
-import tempfile
 
 from optparse import make_option, OptionParser
 
@@ -13,10 +12,22 @@ from ebpub.db.models import Location, LocationType
 from ebpub.metros.allmetros import get_metro
 from ebpub.utils.geodjango import make_multi
 from ebpub.geocoder.parser.parsing import normalize
-from ebpub.utils.script_utils import die, makedirs, wget, unzip
+from ebpub.utils.script_utils import die
+
+from openrural.downloads import DownloadCache, DownloadError
+from openrural.geometry import LayerTransformer
 
 
 class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-d", "--dir", action="store", type="string", dest="dir",
+                    help="Download cache directory (default "
+                         "DOWNLOAD_CACHE_DIR)"),
+        make_option("-m", "--mirror", action="store", type="string",
+                    dest="mirror",
+                    help="Read City.zip from this directory instead of "
+                         "downloading it"),
+    )
     help = 'Import Columbus County city boundaries'
     url = 'http://www.columbusco.org/GISData/City.zip'
 
@@ -24,16 +35,18 @@ class Command(BaseCommand):
         # convert "BRUNSWICK CITY LIMITS" to "BRUNCSWICK"
         return unicode(name).replace(' CITY LIMITS', '')
 
-    def download_file(self):
-        tmp = tempfile.mkdtemp()
-        wget(self.url, cwd=tmp) or die("Could not download %s" % self.url)
-        zip_path = os.path.join(tmp, 'City.zip')
-        unzip(zip_path, cwd=tmp) or die("failed to unzip %s" % tmp)
-        shapefile = os.path.join(tmp, 'City.shp')
+    def download_file(self, cache):
+        try:
+            folder = cache.unzip(cache.fetch(self.url))
+        except DownloadError, e:
+            die(str(e))
+        cache.prune()
+        shapefile = os.path.join(folder, 'City.shp')
         return shapefile
 
     def handle(self, **options):
-        shapefile = self.download_file()
+        cache = DownloadCache(options['dir'], mirror=options['mirror'])
+        shapefile = self.download_file(cache)
         now = datetime.datetime.now()
         metro_name = get_metro()['metro_name'].upper()
         # get or create City location type
@@ -49,10 +62,9 @@ class Command(BaseCommand):
         # build list of cities
         locations = {}
         layer = DataSource(shapefile)[0]
-        for feature in layer:
+        for feature, geom in LayerTransformer().features(layer):
             name = self.clean_name(feature['Name'])
-            # convert to 4326
-            geom = feature.geom.transform(4326, True).geos
+            geom = geom.geos
             if name not in locations:
                 locations[name] = {
                     'name': name,
@@ -19,66 +19,130 @@
 
 # Based on http://wiki.github.com/dkukral/everyblock/install-everyblock
 
-from django.core.management.base import BaseCommand
-from ebpub.utils.script_utils import die, makedirs, wget, unzip
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from ebpub.streets.blockimport.tiger.import_blocks import TigerImporter
+from ebpub.streets.models import Block, BlockIntersection, Intersection, \
+    Street
+from ebpub.utils.script_utils import die
 import os
-import tempfile
+import time
+import multiprocessing
 from optparse import make_option, OptionParser
 
+from openrural import dbfcache
+from openrural.downloads import DownloadCache, DownloadError
+
+
+class ColumnarTigerImporter(TigerImporter):
+    """
+    Reads featnames and faces from their columnar caches (see
+    openrural.dbfcache), so re-importing a county doesn't parse the DBFs
+    again.
+    """
+
+    def _load_rel_db(self, dbf_file, rel_key):
+        db = dbfcache.load_rel_db(dbf_file, rel_key)
+        self.log("Unique keys for %r: %d" % (rel_key, len(db)))
+        return db
+
+
+STATE = '37' # NC
+BASEURL= 'ftp://ftp2.census.gov/geo/tiger/TIGER2010'
+
+
+def _import_county(args):
+    """Imports one county's blocks; run in a worker process."""
+    county, folders, place_folder = args
+    from ebpub.utils.geodjango import get_default_bounds
+    start = time.time()
+    # Passing --city means we skip features labeled for other cities.
+    if dbfcache.numpy_available():
+        importer_class = ColumnarTigerImporter
+    else:
+        importer_class = TigerImporter
+    importer = importer_class(
+        '%s/tl_2010_%s_edges.shp' % (folders['edges'], county),
+        '%s/tl_2010_%s_featnames.dbf' % (folders['featnames'], county),
+        '%s/tl_2010_%s_faces.dbf' % (folders['faces'], county),
+        '%s/tl_2010_%s_place10.shp' % (place_folder, STATE),
+        encoding='utf8',
+        filter_bounds=get_default_bounds())
+    num_created = importer.save()
+    connection.close()
+    return county, num_created, time.time() - start
+
 
 class Command(BaseCommand):
+    args = '<county FIPS code> [<county FIPS code> ...]'
     option_list = BaseCommand.option_list + (
-        make_option("-d", "--dir", action="store", type="string", dest="dir"),
+        make_option("-d", "--dir", action="store", type="string", dest="dir",
+                    help="Download cache directory (default "
+                         "DOWNLOAD_CACHE_DIR)"),
+        make_option("-m", "--mirror", action="store", type="string",
+                    dest="mirror",
+                    help="Read the TIGER zipfiles from this directory "
+                         "instead of downloading them"),
+        make_option("-w", "--workers", action="store", type="int",
+                    dest="workers", default=1,
+                    help="Number of counties imported at once"),
     )
-    help = 'Import NC streets & blocks for the given county to ebpub.'
+    help = 'Import NC streets & blocks for the given counties to ebpub.'
 
-    def handle(self, county, **options):
+    def handle(self, *counties, **options):
+        if not counties:
+            raise CommandError('Please give at least one county FIPS code')
         # First we download a bunch of zipfiles of TIGER data.
-        if options['dir']:
-            TMP = options['dir']
-            download = not os.path.exists(TMP)
-            if download:
-                os.makedirs(TMP)
-        else:
-            TMP = tempfile.mkdtemp()
-            download = True
-        os.chdir(TMP)
-        OUTDIR = os.path.join(TMP, 'tiger_data')
-        STATE = '37' # NC
-        if download:
-            print 'Download TIGER data to %s' % TMP
-            BASEURL= 'ftp://ftp2.census.gov/geo/tiger/TIGER2010'
-            ZIPS = ("PLACE/2010/tl_2010_%s_place10.zip" % STATE,
-                    "EDGES/tl_2010_%s_edges.zip" % county,
-                    "FACES/tl_2010_%s_faces.zip" % county,
-                    "FEATNAMES/tl_2010_%s_featnames.zip" % county,
-                    )
-            makedirs(OUTDIR) or die("couldn't create directory %s" % OUTDIR)
-            for fname in ZIPS:
-                wget('%s/%s' % (BASEURL, fname), cwd=OUTDIR) or die(
-                    "Could not download %s/%s" % (BASEURL, fname))
-
-            import glob
-            for fname in glob.glob(os.path.join(OUTDIR, '*zip')):
-                unzip(fname, cwd=OUTDIR) or die("Could not unzip %s" % fname)
-            print "Shapefiles unzipped in %s" % OUTDIR
+        start = time.time()
+        urls = {('place', None): "%s/PLACE/2010/tl_2010_%s_place10.zip" % (
+            BASEURL, STATE)}
+        for county in counties:
+            urls[('edges', county)] = "%s/EDGES/tl_2010_%s_edges.zip" % (
+                BASEURL, county)
+            urls[('faces', county)] = "%s/FACES/tl_2010_%s_faces.zip" % (
+                BASEURL, county)
+            urls[('featnames', county)] = \
+                "%s/FEATNAMES/tl_2010_%s_featnames.zip" % (BASEURL, county)
+        cache = DownloadCache(options['dir'], mirror=options['mirror'])
+        print 'Fetching TIGER data into %s' % cache.path
+        try:
+            archives = cache.fetch_many(urls.values())
+            folders = dict([(key, cache.unzip(archives[url]))
+                            for key, url in urls.iteritems()])
+        except DownloadError, e:
+            die(str(e))
+        print "Shapefiles unzipped in %s (%.1fs)" % (
+            os.path.join(cache.path, 'unzipped'), time.time() - start)
 
         # Now we load them into our blocks table.
-        from ebpub.streets.blockimport.tiger import import_blocks
-        from ebpub.utils.geodjango import get_default_bounds
         print "Importing blocks, this may take several minutes ..."
-
-        # Passing --city means we skip features labeled for other cities.
-
-        importer = import_blocks.TigerImporter(
-            '%s/tl_2010_%s_edges.shp' % (OUTDIR, county),
-            '%s/tl_2010_%s_featnames.dbf' % (OUTDIR, county),
-            '%s/tl_2010_%s_faces.dbf' % (OUTDIR, county),
-            '%s/tl_2010_%s_place10.shp' % (OUTDIR, STATE),
-            encoding='utf8',
-            filter_bounds=get_default_bounds())
-        num_created = importer.save()
-        print "Created %d blocks" % num_created
+        start = time.time()
+        jobs = []
+        for county in counties:
+            county_folders = dict([(name, folders[(name, county)])
+                                   for name in ('edges', 'faces',
+                                                'featnames')])
+            jobs.append((county, county_folders, folders[('place', None)]))
+        workers = min(options['workers'], len(jobs))
+        if workers > 1:
+            # workers mustn't share the parent's connection
+            connection.close()
+            pool = multiprocessing.Pool(workers)
+            try:
+                results = pool.imap_unordered(_import_county, jobs)
+                for county, num_created, seconds in results:
+                    print "County %s: created %d blocks in %.1fs" % (
+                        county, num_created, seconds)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for job in jobs:
+                county, num_created, seconds = _import_county(job)
+                print "County %s: created %d blocks in %.1fs" % (
+                    county, num_created, seconds)
+        print "Imported blocks in %.1fs, %d blocks in total" % (
+            time.time() - start, Block.objects.count())
 
         #########################
 
@@ -88,11 +152,13 @@ class Command(BaseCommand):
         # after you have imported *all* your blocks.
 
         from ebpub.streets.bin import populate_streets
-        populate_streets.main(['streets'])
-        populate_streets.main(['block_intersections'])
-        populate_streets.main(['intersections'])
+        for stage, model in (('streets', Street),
+                             ('block_intersections', BlockIntersection),
+                             ('intersections', Intersection)):
+            start = time.time()
+            populate_streets.main([stage])
+            print "%s: %d rows in %.1fs" % (stage, model.objects.count(),
+                                            time.time() - start)
+        from openrural.retrieval.streetindex import street_index_changed
+        street_index_changed()
         print "Done."
-
-        print "Removing temp directory %s" % TMP
-        if not options['dir']:
-            os.system('rm -rf %s' % TMP)
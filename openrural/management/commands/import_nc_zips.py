@@ -17,34 +17,39 @@
 #
 
 from django.core.management.base import BaseCommand
-from ebpub.utils.script_utils import die, makedirs, wget, unzip
-import os
-import tempfile
+from ebpub.utils.script_utils import die
+from optparse import make_option
+
+from openrural.downloads import DownloadCache, DownloadError
 
 class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("-d", "--dir", action="store", type="string", dest="dir",
+                    help="Download cache directory (default "
+                         "DOWNLOAD_CACHE_DIR)"),
+        make_option("-m", "--mirror", action="store", type="string",
+                    dest="mirror",
+                    help="Read the zipfile from this directory instead of "
+                         "downloading it"),
+    )
     help = 'Import NC zip codes'
 
     def handle(self, *args, **options):
         
-        TMP = tempfile.mkdtemp()
-        print 'Download TIGER data to %s' % TMP
-        os.chdir(TMP)
+        cache = DownloadCache(options['dir'], mirror=options['mirror'])
+        print 'Fetching TIGER data into %s' % cache.path
         
         ZIP_SERVER = "http://www2.census.gov/geo/tiger/TIGER2009/37_NORTH_CAROLINA/"
         ZIP_FILE = "tl_2009_37_zcta5.zip"
         ZIP_URL = "%s/%s" % (ZIP_SERVER, ZIP_FILE)
-        ZIP_FOLDER = os.path.join(TMP, 'zip_data')
-        makedirs(ZIP_FOLDER) or die("couldn't create %s" % ZIP_FOLDER)
 
         print "Downloading zip code data..."
-        wget(ZIP_URL, cwd=ZIP_FOLDER) or die("Could not download %s" % ZIP_URL)
-        zip_path = os.path.join(ZIP_FOLDER, ZIP_FILE)
-        unzip(zip_path, cwd=ZIP_FOLDER) or die("failed to unzip %s" % zip_path)
+        try:
+            ZIP_FOLDER = cache.unzip(cache.fetch(ZIP_URL))
+        except DownloadError, e:
+            die(str(e))
+        cache.prune()
 
         print "Importing zip codes..."
         from ebpub.db.bin import import_zips
         import_zips.main([ZIP_FOLDER, '-v', '-b'])
-
-        print "Removing temp directory %s" % TMP
-        os.system('rm -rf %s' % TMP)
-
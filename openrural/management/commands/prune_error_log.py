@@ -0,0 +1,56 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from openrural.error_log import retention
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', action='store', type='int',
+                    dest='chunk_size', default=1000,
+                    help='Rows deleted or moved per transaction '
+                         '(default 1000)'),
+        make_option('--pause', action='store', type='float', dest='pause',
+                    default=0,
+                    help='Seconds to sleep between chunks'),
+        make_option('-n', '--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Only count the rows that would be deleted'),
+        make_option('--partition', action='store_true', dest='partition',
+                    default=False,
+                    help='Move finished months of Geocode and Message rows '
+                         'into monthly tables, and drop the expired ones '
+                         '(PostgreSQL only)'),
+    )
+    help = 'Delete error_log rows older than ERROR_LOG_RETENTION.'
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])
+        if options['partition']:
+            engine = settings.DATABASES['default']['ENGINE']
+            if 'postgis' not in engine and 'postgresql' not in engine:
+                raise CommandError('--partition needs PostgreSQL')
+            for model in retention.PARTITIONED_MODELS:
+                if not options['dry_run']:
+                    children = retention.partition(
+                        model, chunk_size=options['chunk_size'],
+                        pause=options['pause'])
+                    for child in children:
+                        if verbosity > 1:
+                            print "Moved rows into %s" % child
+                dropped = retention.drop_partitions(
+                    model, dry_run=options['dry_run'])
+                for child in dropped:
+                    print "%s %s" % (
+                        'Would drop' if options['dry_run'] else 'Dropped',
+                        child)
+        results = retention.prune(chunk_size=options['chunk_size'],
+                                  pause=options['pause'],
+                                  dry_run=options['dry_run'])
+        for name, key, cutoff, count in results:
+            if count or verbosity > 1:
+                print "%s (%s) before %s: %d %s" % (
+                    name, key, cutoff.strftime('%Y-%m-%d'), count,
+                    'to delete' if options['dry_run'] else 'deleted')
@@ -0,0 +1,50 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from openrural.error_log.models import Geocode
+from openrural.error_log.regeocode import regeocode
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('-s', '--scraper', action='append', dest='scrapers',
+                    default=[], help='Only geocodes of this scraper'),
+        make_option('-b', '--batch', action='append', type='int',
+                    dest='batches', default=[],
+                    help='Only geocodes of this batch id'),
+        make_option('-e', '--error', action='append', dest='errors',
+                    default=[],
+                    help='Only geocodes that failed with this exception, '
+                         'e.g. DoesNotExist'),
+        make_option('-w', '--workers', action='store', type='int',
+                    dest='workers', default=1,
+                    help='Number of geocoding processes'),
+        make_option('--chunk-size', action='store', type='int',
+                    dest='chunk_size', default=500,
+                    help='Locations updated per transaction (default 500)'),
+    )
+    help = 'Geocode failed error_log geocodes again, fixing their news items.'
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])
+        geocodes = Geocode.objects.all()
+        if options['scrapers']:
+            geocodes = geocodes.filter(scraper__in=options['scrapers'])
+        if options['batches']:
+            geocodes = geocodes.filter(batch__in=options['batches'])
+        if options['errors']:
+            geocodes = geocodes.filter(name__in=options['errors'])
+        start = time.time()
+
+        def progress(done, total, fixed):
+            if verbosity > 0:
+                elapsed = time.time() - start
+                print "%d/%d locations, %d geocodes fixed (%.1f locations/s)" % (
+                    done, total, fixed, done / max(elapsed, 0.001))
+
+        tried, located, fixed = regeocode(geocodes, options['workers'],
+                                          options['chunk_size'], progress)
+        print "Located %d of %d locations, fixing %d geocodes in %.1fs" % (
+            located, tried, fixed, time.time() - start)
@@ -3,3 +3,46 @@
 # (i.e. have models.)
 # Also needed if you write tests and want the default testrunner to
 # be able to find them.
+
+from django.contrib.gis.db import models
+
+from ebpub.db.models import NewsItem, Schema
+
+
+class CachedGeocode(models.Model):
+    """
+    Result of a remote (e.g. Google) geocoder lookup, keyed by normalized
+    location string.  Failed lookups are cached too, with a shorter expiry.
+    """
+    normalized_location = models.CharField(max_length=1024, unique=True)
+    success = models.BooleanField(default=True)
+    point = models.PointField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    expires = models.DateTimeField(db_index=True)
+
+    objects = models.GeoManager()
+
+    def __unicode__(self):
+        return self.normalized_location
+
+
+class RowFingerprint(models.Model):
+    """
+    Digest of the source row a NewsItem was imported from, keyed by schema
+    and the row's natural key, so that re-importing a full export only
+    touches new and changed rows.
+    """
+    schema = models.ForeignKey(Schema, related_name='row_fingerprints')
+    key = models.CharField(max_length=255)
+    digest = models.CharField(max_length=40)
+    news_item = models.ForeignKey(NewsItem, related_name='row_fingerprints',
+                                  null=True, blank=True,
+                                  on_delete=models.SET_NULL)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta(object):
+        unique_together = (('schema', 'key'),)
+
+    def __unicode__(self):
+        return self.key
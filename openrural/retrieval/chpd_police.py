@@ -5,7 +5,7 @@ import datetime
 from optparse import OptionParser
 
 from ebpub import geocoder
-from ebpub.db.models import NewsItem, Schema, SchemaField, Lookup
+from ebpub.db.models import Schema, SchemaField, Lookup
 from ebpub.streets.models import ImproperCity
 from ebpub.utils.script_utils import add_verbosity_options, setup_logging_from_opts
 import ebdata.retrieval.log  # sets up base handlers.
@@ -21,7 +21,10 @@ class Scraper(ScraperWikiScraper):
 
     scraper_name = "chapel_hill_police_reports"
     list_filter = {}
+    # keyset pages come oldest first; ordering only applies without keyset
     ordering = 'date DESC'
+    keyset = 'date'
+    key_field = 'date'
 
     schema_slugs = [SCHEMA_SLUG]
     has_detail = False
@@ -53,14 +56,13 @@ class Scraper(ScraperWikiScraper):
             city='Chapel Hill',
         )
 
-    def existing_record(self, record):
-        try:
-            qs = NewsItem.objects.filter(schema__id=self.schema.id)
-            date = self._parse_date(record['date'])
-            qs = qs.by_attribute(self.schema_fields['date'], date)
-            return qs[0]
-        except IndexError:
-            return None
+    def geocode_location(self, record):
+        if record['location']:
+            return (record['location'], None)
+        return None
+
+    def record_key(self, record):
+        return self._parse_date(record['date'])
 
     def _create_schema(self):
         try:
@@ -126,9 +128,19 @@ def main():
     parser = OptionParser()
     parser.add_option('-c', '--clear', help='Clear schema',
                       action="store_true", dest="clear")
+    parser.add_option('-w', '--fetch-workers', type='int', default=1,
+                      dest='fetch_workers',
+                      help='Number of threads prefetching pages')
+    parser.add_option('-g', '--geocode-workers', type='int', default=1,
+                      dest='geocode_workers',
+                      help='Number of processes geocoding addresses')
+    parser.add_option('-f', '--full', help='Ignore the high-water mark and '
+                      'resync every row', action="store_true", dest="full")
     add_verbosity_options(parser)
     opts, args = parser.parse_args(sys.argv)
-    scraper = Scraper(clear=opts.clear)
+    scraper = Scraper(clear=opts.clear, full=opts.full,
+                      fetch_workers=opts.fetch_workers,
+                      geocode_workers=opts.geocode_workers)
     setup_logging_from_opts(opts, scraper.logger)
     scraper.update()
 
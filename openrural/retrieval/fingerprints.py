@@ -0,0 +1,98 @@
+"""
+Change detection for scrapers that import a full export every time.
+
+Each imported row is remembered as a RowFingerprint: the schema, the row's
+natural key, a digest of its content and the NewsItem made from it. A
+FingerprintSet looks up the fingerprints of a batch of rows at once and
+tells which of them are new, changed or unchanged since the last import.
+"""
+
+import hashlib
+
+from django.db import IntegrityError, transaction
+from django.utils.encoding import smart_str
+
+from openrural.models import RowFingerprint
+
+
+__all__ = ('FingerprintSet', 'row_digest', 'NEW', 'CHANGED', 'UNCHANGED')
+
+
+NEW, CHANGED, UNCHANGED = 'new', 'changed', 'unchanged'
+
+
+def row_digest(values):
+    """Returns the SHA-1 of a sequence of values, e.g. a CSV row."""
+    digest = hashlib.sha1()
+    for value in values:
+        digest.update(smart_str(value))
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+class FingerprintSet(object):
+    """The fingerprints of the rows with ``keys`` in ``schema``."""
+
+    # keys looked up per query
+    batch_size = 500
+
+    def __init__(self, schema, keys):
+        self.schema = schema
+        self.fingerprints = {}
+        keys = list(set(keys))
+        for start in xrange(0, len(keys), self.batch_size):
+            qs = RowFingerprint.objects.filter(
+                schema=schema, key__in=keys[start:start + self.batch_size])
+            for fingerprint in qs:
+                self.fingerprints[fingerprint.key] = fingerprint
+
+    def status(self, key, digest, claim=False):
+        """
+        Returns (NEW, None), or (CHANGED or UNCHANGED, the RowFingerprint)
+        for the row with ``key`` and ``digest``. Rows whose NewsItem has
+        been deleted are new again.
+
+        With ``claim``, a new row's fingerprint is inserted right away, so
+        that of two processes importing the same key only one creates a
+        NewsItem; the other waits for it and compares against its row.
+        """
+        fingerprint = self.fingerprints.get(key)
+        if fingerprint is None and claim:
+            fingerprint = self._claim(key)
+        if fingerprint is None or fingerprint.news_item_id is None:
+            return NEW, None
+        if fingerprint.digest == digest:
+            return UNCHANGED, fingerprint
+        return CHANGED, fingerprint
+
+    def _claim(self, key):
+        managed = transaction.is_managed()
+        if managed:
+            sid = transaction.savepoint()
+        try:
+            fingerprint = RowFingerprint.objects.create(
+                schema=self.schema, key=key, digest='')
+        except IntegrityError:
+            # inserted by another process since the lookup
+            if managed:
+                transaction.savepoint_rollback(sid)
+            else:
+                transaction.rollback_unless_managed()
+            fingerprint = RowFingerprint.objects.get(schema=self.schema,
+                                                     key=key)
+        else:
+            if managed:
+                transaction.savepoint_commit(sid)
+        self.fingerprints[key] = fingerprint
+        return fingerprint
+
+    def save(self, key, digest, news_item):
+        """Records that ``news_item`` was saved from this row."""
+        fingerprint = self.fingerprints.get(key)
+        if fingerprint is None:
+            fingerprint = RowFingerprint(schema=self.schema, key=key)
+            self.fingerprints[key] = fingerprint
+        fingerprint.digest = digest
+        fingerprint.news_item = news_item
+        fingerprint.save()
+        return fingerprint
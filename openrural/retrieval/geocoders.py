@@ -1,20 +1,383 @@
+import time
+import datetime
+import threading
+import traceback
+import multiprocessing
+
 from django.conf import settings
+from django.db import connection
+from django.core.cache import cache
 from django.contrib.gis.geos import Point
+from django.core.urlresolvers import NoReverseMatch
+
+from ebpub.geocoder import Geocoder, DoesNotExist, GeocodingException, \
+    SmartGeocoder
+from ebpub.geocoder.parser.parsing import normalize, ParsingError
+from ebpub.streets.models import ImproperCity
+
+from openrural.models import CachedGeocode
+from openrural.retrieval.streetindex import VERSION_KEY, CHECK_INTERVAL
+
+
+# Exceptions meaning "this location can't be geocoded", as opposed to
+# database or network trouble, which is never remembered.
+GEOCODE_ERRORS = (GeocodingException, ParsingError, ImproperCity,
+                  NoReverseMatch)
+
+
+class LRUCache(object):
+    """
+    A dictionary holding at most ``size`` items, discarding the least
+    recently used one when full.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._data = {}
+        # circular doubly linked list of [prev, next, key] links; the
+        # root's next link is the most recently used key
+        self._root = root = []
+        root[:] = [root, root, None]
+        self._links = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def _unlink(self, link):
+        prev, next, key = link
+        prev[1] = next
+        next[0] = prev
+
+    def _push(self, key):
+        root = self._root
+        link = [root, root[1], key]
+        root[1][0] = link
+        root[1] = link
+        self._links[key] = link
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        self._unlink(self._links[key])
+        self._push(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            self._unlink(self._links[key])
+        elif len(self._data) >= self.size:
+            oldest = self._root[0]
+            self._unlink(oldest)
+            del self._links[oldest[2]]
+            del self._data[oldest[2]]
+        self._data[key] = value
+        self._push(key)
+
+    def clear(self):
+        self._data.clear()
+        self._links.clear()
+        self._root[:] = [self._root, self._root, None]
+
+
+class GeocodeMemo(object):
+    """
+    Remembers the outcome of geocoding each distinct (location, zipcode)
+    pair for the life of a scraper run, so rows repeating an address reuse
+    the first result -- or re-raise the first failure -- instead of going
+    back to the geocoder.
+
+    Failures keep the traceback of the original lookup in their
+    ``geocode_traceback`` attribute.
+    """
+
+    def __init__(self, geocoder):
+        self.geocoder = geocoder
+        self.outcomes = {}
+        self.prefetched = set()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, location_name, zipcode=None):
+        return (normalize(location_name), zipcode or '')
+
+    def geocode(self, location_name, zipcode=None):
+        key = self.key(location_name, zipcode)
+        try:
+            result, error = self.outcomes[key]
+        except KeyError:
+            self.misses += 1
+            result, error = self._geocode(location_name)
+            self.outcomes[key] = (result, error)
+        else:
+            if key in self.prefetched:
+                # first use of a result fetched by prefetch()
+                self.prefetched.discard(key)
+                self.misses += 1
+            else:
+                self.hits += 1
+        if error is not None:
+            raise error
+        return result
+
+    def prefetch(self, locations, pool):
+        """
+        Geocodes the (location_name, zipcode) pairs in ``locations`` that
+        haven't been seen yet on ``pool``, a GeocoderPool, so the rows
+        that need them find their outcomes already memoized.
+        """
+        todo = {}
+        for location_name, zipcode in locations:
+            key = self.key(location_name, zipcode)
+            if key not in self.outcomes and key not in todo:
+                todo[key] = location_name
+        keys = todo.keys()
+        outcomes = pool.geocode_many([todo[key] for key in keys])
+        for key, outcome in zip(keys, outcomes):
+            self.outcomes[key] = outcome
+            self.prefetched.add(key)
+
+    def _geocode(self, location_name):
+        try:
+            return self.geocoder.geocode(location_name), None
+        except GEOCODE_ERRORS, e:
+            # a CachingGeocoder may have kept the original traceback
+            e.geocode_traceback = getattr(e, 'geocode_traceback', None) or \
+                traceback.format_exc()
+            return None, e
 
-from geopy import geocoders
-from geopy.geocoders.google import GQueryError
 
-from ebpub.geocoder import Geocoder, DoesNotExist
+def _init_pool_worker(geocoder_class):
+    global _pool_geocoder
+    _pool_geocoder = geocoder_class()
+
+
+def _pool_geocode(location_name):
+    """
+    Geocodes one location in a pool worker.  Geocoder exceptions don't
+    all survive pickling, so failures travel as their class and state.
+    """
+    try:
+        return _pool_geocoder.geocode(location_name), None
+    except GEOCODE_ERRORS, e:
+        return None, (type(e), e.args, e.__dict__, traceback.format_exc())
+
+
+class GeocoderPool(object):
+    """
+    Geocodes batches of locations in worker processes, each with its own
+    geocoder and database connection, returning (result, error) outcomes
+    in input order.
+    """
+
+    chunksize = 10
+
+    def __init__(self, processes, geocoder_class=SmartGeocoder):
+        # Forked workers mustn't share the parent's connection socket;
+        # close it so the parent and every worker open their own.
+        connection.close()
+        self.pool = multiprocessing.Pool(processes, _init_pool_worker,
+                                         (geocoder_class,))
+
+    def geocode_many(self, location_names):
+        outcomes = []
+        for result, error in self.pool.imap(_pool_geocode, location_names,
+                                            self.chunksize):
+            if error is not None:
+                cls, args, state, tb = error
+                error = cls.__new__(cls)
+                error.args = args
+                error.__dict__.update(state)
+                error.geocode_traceback = tb
+            outcomes.append((result, error))
+        return outcomes
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def make_geocoder(geocoder_type=None):
+    """
+    Returns a new geocoder of the given type: 'openblock', 'memory' or
+    'google'. Defaults to settings.OPENRURAL_GEOCODER.
+    """
+    if geocoder_type is None:
+        geocoder_type = getattr(settings, 'OPENRURAL_GEOCODER', 'openblock')
+    if geocoder_type == 'google':
+        return GoogleGeocoder()
+    elif geocoder_type == 'memory':
+        from openrural.retrieval.streetindex import MemoryGeocoder
+        return MemoryGeocoder()
+    elif geocoder_type == 'openblock':
+        return SmartGeocoder()
+    raise ValueError('Unknown geocoder type: %r' % geocoder_type)
+
+
+class CachingGeocoder(object):
+    """
+    Wraps a geocoder (by default the configured one, see make_geocoder()),
+    remembering the outcomes of the last SHARED_GEOCODER_CACHE_SIZE
+    lookups. Failures are only remembered for
+    SHARED_GEOCODER_ERROR_TTL (a timedelta), since fixing streets or
+    misspellings can make them succeed. Everything is forgotten once
+    streets are imported (see streetindex.street_index_changed()).
+    """
+
+    def __init__(self, geocoder=None):
+        self.geocoder = geocoder or make_geocoder()
+        self.cache = LRUCache(getattr(settings, 'SHARED_GEOCODER_CACHE_SIZE',
+                                      1000))
+        self.error_ttl = getattr(settings, 'SHARED_GEOCODER_ERROR_TTL',
+                                 datetime.timedelta(minutes=10))
+        self.hits = 0
+        self.misses = 0
+        # shared by the threads of a web server process
+        self.lock = threading.Lock()
+        self.version = cache.get(VERSION_KEY)
+        self.checked = time.time()
+
+    def _check_version(self):
+        """Empties the cache if streets changed; call with the lock held."""
+        if time.time() - self.checked < CHECK_INTERVAL:
+            return
+        self.checked = time.time()
+        version = cache.get(VERSION_KEY)
+        if version != self.version:
+            self.version = version
+            self.cache.clear()
+
+    def geocode(self, location):
+        key = normalize(location)
+        now = datetime.datetime.now()
+        with self.lock:
+            self._check_version()
+            entry = self.cache.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < now:
+                entry = None
+            if entry is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is None:
+            try:
+                entry = (self.geocoder.geocode(location), None, None)
+            except GEOCODE_ERRORS, e:
+                e.geocode_traceback = traceback.format_exc()
+                entry = (None, e, now + self.error_ttl)
+            with self.lock:
+                self.cache[key] = entry
+        result, error, expires = entry
+        if error is not None:
+            raise error
+        return result
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.version = cache.get(VERSION_KEY)
+            self.checked = time.time()
+
+
+_shared_geocoder = None
+_shared_geocoder_lock = threading.Lock()
+
+
+def get_shared_geocoder():
+    """
+    Returns this process's CachingGeocoder, shared by the error log admin,
+    the scrapers and the re-geocoding tools.
+    """
+    global _shared_geocoder
+    with _shared_geocoder_lock:
+        if _shared_geocoder is None:
+            _shared_geocoder = CachingGeocoder()
+        return _shared_geocoder
+
+
+def clear_shared_geocoder():
+    """Empties this process's CachingGeocoder, if it has been created."""
+    if _shared_geocoder is not None:
+        _shared_geocoder.clear()
 
 
 class GoogleGeocoder(Geocoder):
+    """
+    Geocodes through the Google Maps API, caching results in the
+    CachedGeocode table (and an in-process LRU in front of it) so repeated
+    runs don't pay for the same lookups again.
+
+    Cache expiry and size are set with GEOCODE_CACHE_TTL,
+    GEOCODE_CACHE_NEGATIVE_TTL (timedeltas) and GEOCODE_CACHE_SIZE.
+    """
 
     def __init__(self, *args, **kwargs):
-        kwargs['use_cache'] = False # haven't implemented cache yet
+        # ebpub's GeocoderCache can't expire entries or remember failures;
+        # geocode() below does its own caching instead.
+        kwargs['use_cache'] = False
         super(GoogleGeocoder, self).__init__(*args, **kwargs)
+        # geopy is only needed by sites geocoding through Google
+        from geopy import geocoders
         self.geocoder = geocoders.Google(settings.GOOGLE_MAPS_API_KEY)
+        self.ttl = getattr(settings, 'GEOCODE_CACHE_TTL',
+                           datetime.timedelta(days=90))
+        self.negative_ttl = getattr(settings, 'GEOCODE_CACHE_NEGATIVE_TTL',
+                                    datetime.timedelta(days=1))
+        self.memory = LRUCache(getattr(settings, 'GEOCODE_CACHE_SIZE', 1000))
+        self.hits = 0
+        self.misses = 0
+
+    def geocode(self, location):
+        key = normalize(location)
+        now = datetime.datetime.now()
+        entry = self.memory.get(key)
+        if entry is None or entry.expires <= now:
+            try:
+                entry = CachedGeocode.objects.filter(normalized_location=key,
+                                                     expires__gt=now)[0]
+            except IndexError:
+                entry = None
+        if entry is None:
+            self.misses += 1
+            entry = self._lookup(key, now)
+        else:
+            self.hits += 1
+        self.memory[key] = entry
+        if not entry.success:
+            raise DoesNotExist(entry.error)
+        return {'point': entry.point}
+
+    def _lookup(self, key, now):
+        try:
+            result = super(GoogleGeocoder, self).geocode(key)
+        except DoesNotExist, e:
+            values = {'success': False, 'point': None, 'error': unicode(e),
+                      'expires': now + self.negative_ttl}
+        else:
+            values = {'success': True, 'point': result['point'], 'error': '',
+                      'expires': now + self.ttl}
+        entry, created = CachedGeocode.objects.get_or_create(
+            normalized_location=key, defaults=values)
+        if not created:
+            for name, value in values.iteritems():
+                setattr(entry, name, value)
+            entry.save()
+        return entry
 
     def _do_geocode(self, location_string):
+        from geopy.geocoders.google import GQueryError
         try:
             place, (lat, lng) = self.geocoder.geocode(location_string)
         except (GQueryError, ValueError), e:
@@ -5,7 +5,7 @@ import datetime
 from optparse import OptionParser
 
 from ebpub import geocoder
-from ebpub.db.models import NewsItem, Schema, SchemaField
+from ebpub.db.models import Schema, SchemaField
 from ebpub.utils.script_utils import add_verbosity_options, setup_logging_from_opts
 import ebdata.retrieval.log  # sets up base handlers.
 # Note there's an undocumented assumption in ebdata that we want to
@@ -22,6 +22,8 @@ class Scraper(ScraperWikiScraper):
     scraper_name = "nc_secretary_of_state_corporation_filings"
     list_filter = {'Status': 'Current-Active', 'PrinCounty': 'Orange'}
     ordering = 'DateFormed ASC'
+    keyset = 'DateFormed'
+    key_field = 'sosid'
 
     schema_slugs = ('corporations',)
     has_detail = False
@@ -35,19 +37,10 @@ class Scraper(ScraperWikiScraper):
             'sosid': data['SOSID'],
             'agent': data['RegAgent'],
         }
-        address_parts = {
-            'line1': data['PrinAddr1'],
-            'line2': data['PrinAddr2'],
-            'city': data['PrinCity'],
-            'state': data['PrinState'],
-            'zip': data['PrinZip'],
-        }
-        if address_parts['line1'] == 'None':
+        address = self.address(data)
+        if address is None:
             self.logger.debug("{0} has no address, skipping".format(*data))
             return
-        if address_parts['line2']:
-            address_parts['line1'] = address_parts['line2']
-        address = "{line1} {line2}".format(**address_parts)
         item = self.create_or_update(
             old_record,
             attrs,
@@ -56,13 +49,28 @@ class Scraper(ScraperWikiScraper):
             location_name=address,
         )
 
-    def existing_record(self, record):
-        try:
-            qs = NewsItem.objects.filter(schema__id=self.schema.id)
-            qs = qs.by_attribute(self.schema_fields['sosid'], record['SOSID'])
-            return qs[0]
-        except IndexError:
+    def address(self, data):
+        address_parts = {
+            'line1': data['PrinAddr1'],
+            'line2': data['PrinAddr2'],
+            'city': data['PrinCity'],
+            'state': data['PrinState'],
+            'zip': data['PrinZip'],
+        }
+        if address_parts['line1'] == 'None':
             return None
+        if address_parts['line2']:
+            address_parts['line1'] = address_parts['line2']
+        return "{line1} {line2}".format(**address_parts)
+
+    def geocode_location(self, record):
+        address = self.address(record)
+        if address:
+            return (address, None)
+        return None
+
+    def record_key(self, record):
+        return int(record['SOSID'])
 
     def _create_schema(self):
         try:
@@ -112,9 +120,19 @@ def main():
     parser = OptionParser()
     parser.add_option('-c', '--clear', help='Clear schema',
                       action="store_true", dest="clear")
+    parser.add_option('-w', '--fetch-workers', type='int', default=1,
+                      dest='fetch_workers',
+                      help='Number of threads prefetching pages')
+    parser.add_option('-g', '--geocode-workers', type='int', default=1,
+                      dest='geocode_workers',
+                      help='Number of processes geocoding addresses')
+    parser.add_option('-f', '--full', help='Ignore the high-water mark and '
+                      'resync every row', action="store_true", dest="full")
     add_verbosity_options(parser)
     opts, args = parser.parse_args(sys.argv)
-    scraper = Scraper(clear=opts.clear)
+    scraper = Scraper(clear=opts.clear, full=opts.full,
+                      fetch_workers=opts.fetch_workers,
+                      geocode_workers=opts.geocode_workers)
     setup_logging_from_opts(opts, scraper.logger)
     scraper.update()
 
@@ -0,0 +1,166 @@
+"""
+Compact lookups of county parcels by PROP number.
+
+Holding a shapefile's OGR Features in Python keeps the whole GDAL layer
+alive; these indexes keep only what the property scrapers use from each
+parcel: its geometry as WKB (already in EPSG:4326) and a few fields.
+MemoryParcelIndex holds them in a dictionary of tuples; SqliteParcelIndex
+writes them to an SQLite file, so memory stays flat however large the
+layer is.
+"""
+
+import os
+import sqlite3
+import resource
+import tempfile
+from collections import namedtuple
+
+from django.contrib.gis.geos import GEOSGeometry
+
+from openrural.geometry import LayerTransformer
+
+
+__all__ = ('Parcel', 'MemoryParcelIndex', 'SqliteParcelIndex',
+           'PARCEL_INDEXES', 'PropSet', 'peak_rss')
+
+
+PARCEL_FIELDS = ('FULLADD', 'CITY', 'ZIP', 'PHOTO_URL', 'PROPCARD')
+
+
+class Parcel(namedtuple('Parcel', 'wkb fulladd city zip photo_url propcard')):
+    __slots__ = ()
+
+    @property
+    def geom(self):
+        return GEOSGeometry(buffer(self.wkb), srid=4326)
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process, in kilobytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _parcels(layer):
+    """Yields (PROP, Parcel) for the features of ``layer``."""
+    for feature, geom in LayerTransformer().features(layer):
+        wkb = str(geom.wkb)
+        yield int(feature.get('PROP')), Parcel(
+            wkb, *[feature.get(name) for name in PARCEL_FIELDS])
+
+
+class MemoryParcelIndex(object):
+    """Parcels by PROP in a dictionary; the last feature of a PROP wins."""
+
+    def __init__(self, layer):
+        self.parcels = dict(_parcels(layer))
+
+    def __len__(self):
+        return len(self.parcels)
+
+    def get(self, prop):
+        return self.parcels.get(prop)
+
+    def close(self):
+        self.parcels = {}
+
+
+class SqliteParcelIndex(object):
+    """
+    Parcels by PROP in an SQLite database at ``path``, or in a temporary
+    file removed by close().  An existing database is opened as is, so the
+    index can be built once and shared, e.g. by worker processes.
+    """
+
+    batch_size = 1000
+
+    def __init__(self, layer=None, path=None):
+        self.temporary = path is None
+        if self.temporary:
+            fd, path = tempfile.mkstemp(suffix='.sqlite')
+            os.close(fd)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        if layer is not None:
+            self._build(layer)
+
+    def _build(self, layer):
+        db = self.db
+        db.execute('DROP TABLE IF EXISTS parcels')
+        db.execute('CREATE TABLE parcels (prop INTEGER PRIMARY KEY, '
+                   'wkb BLOB, fulladd TEXT, city TEXT, zip TEXT, '
+                   'photo_url TEXT, propcard TEXT)')
+        sql = 'INSERT OR REPLACE INTO parcels VALUES (?, ?, ?, ?, ?, ?, ?)'
+        rows = []
+        for prop, parcel in _parcels(layer):
+            rows.append((prop, sqlite3.Binary(parcel.wkb)) + parcel[1:])
+            if len(rows) >= self.batch_size:
+                db.executemany(sql, rows)
+                rows = []
+        db.executemany(sql, rows)
+        db.commit()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM parcels').fetchone()[0]
+
+    def get(self, prop):
+        row = self.db.execute(
+            'SELECT wkb, fulladd, city, zip, photo_url, propcard '
+            'FROM parcels WHERE prop = ?', (prop,)).fetchone()
+        if row is None:
+            return None
+        return Parcel(str(row[0]), *row[1:])
+
+    def close(self):
+        self.db.close()
+        if self.temporary:
+            os.remove(self.path)
+
+
+# number of bits set in each byte value
+POPCOUNT = [bin(i).count('1') for i in xrange(256)]
+
+
+class PropSet(object):
+    """
+    A set of PROP numbers (non-negative integers) as a bitmap, one bit per
+    number up to the largest one added, for counting large layers and CSV
+    files without keeping their rows.
+    """
+
+    def __init__(self):
+        self.bits = bytearray()
+        self.count = 0
+
+    def add(self, prop):
+        """Adds ``prop``, returning False if it was already there."""
+        if prop < 0:
+            raise ValueError('Negative PROP {0}'.format(prop))
+        byte, bit = prop >> 3, 1 << (prop & 7)
+        if byte >= len(self.bits):
+            # grow geometrically
+            self.bits.extend(bytearray(max(byte + 1, 2 * len(self.bits)) -
+                                       len(self.bits)))
+        if self.bits[byte] & bit:
+            return False
+        self.bits[byte] |= bit
+        self.count += 1
+        return True
+
+    def __contains__(self, prop):
+        byte = prop >> 3
+        return 0 <= byte < len(self.bits) and \
+            bool(self.bits[byte] & (1 << (prop & 7)))
+
+    def __len__(self):
+        return self.count
+
+    def intersection_count(self, other):
+        """Returns the number of PROPs in both this set and ``other``."""
+        return sum([POPCOUNT[a & b] for a, b in zip(self.bits, other.bits)])
+
+
+PARCEL_INDEXES = {
+    'memory': MemoryParcelIndex,
+    'sqlite': SqliteParcelIndex,
+}
@@ -1,32 +1,85 @@
 
+import sys
 import json
 import urllib
 import urllib2
 import logging
 import datetime
+import threading
 import traceback
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 import ebdata.retrieval.log  # sets up base handlers.
+from ebdata.retrieval import Retriever
 from ebdata.retrieval.scrapers.newsitem_list_detail import NewsItemListDetailScraper
+from ebpub.db.models import NewsItem
 from ebpub.geocoder import GeocodingException, ParsingError, AmbiguousResult
+from ebpub.utils.text import address_to_block
 
 from openrural.error_log import models as error_log
+from openrural.retrieval.geocoders import CachingGeocoder, GeocodeMemo, \
+    GeocoderPool, get_shared_geocoder, make_geocoder
+from openrural.retrieval.writer import NewsItemWriter
 from django.core.urlresolvers import NoReverseMatch
+from django.db import IntegrityError
 
 
 logging.getLogger().setLevel(logging.DEBUG)
 
+# Column alias used to carry SQLite's rowid along with keyset pages.
+ROWID = '_rowid'
+
+
+class Deferred(object):
+    """Stand-in for an AsyncResult when pages are fetched inline."""
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def get(self):
+        return self.func(*self.args)
+
 
 class ScraperWikiScraper(NewsItemListDetailScraper):
 
     url = "http://api.scraperwiki.com/api/1.0/datastore/sqlite"
     list_filter = None
     ordering = None
+    # Name of a monotonic column to page through the datastore with
+    # (keyset pagination).  When set, each page is fetched with
+    # ``WHERE (keyset, rowid) > (last seen)`` instead of OFFSET, so the
+    # remote SQLite never rescans earlier rows.  SQLite's rowid breaks
+    # ties between rows sharing the same keyset value.  Keyset pages are
+    # always in ascending order; ``ordering`` only applies to OFFSET paging.
+    # Rows whose keyset value is NULL never compare greater than a seek
+    # position, so they're read in a separate pass, by rowid.
+    keyset = None
     limit = 50
-    geocoder_type = 'openblock'
+    # 'openblock', 'memory' or 'google'; None uses OPENRURAL_GEOCODER
+    geocoder_type = None
+    # Name of the SchemaField identifying a row; existing NewsItems are
+    # looked up by it a page at a time (see existing_records()).
+    key_field = None
+    # Number of threads downloading upcoming pages while the current one
+    # is parsed and saved, and how many pages may be fetched ahead of the
+    # one being processed (defaults to twice the number of workers).
+    fetch_workers = 1
+    fetch_queue = None
+    # Number of processes geocoding each page's distinct addresses ahead
+    # of save(); 1 geocodes inline, row by row.
+    geocode_workers = 1
 
     def __init__(self, *args, **kwargs):
         clear = kwargs.pop('clear', False)
+        full = kwargs.pop('full', False)
+        self.fetch_workers = kwargs.pop('fetch_workers', self.fetch_workers)
+        self.geocode_workers = kwargs.pop('geocode_workers',
+                                          self.geocode_workers)
+        self.geocode_pool = None
+        self.use_cache = kwargs.get('use_cache', True)
+        self._fetch_local = threading.local()
         super(ScraperWikiScraper, self).__init__(*args, **kwargs)
         if clear:
             self._create_schema()
@@ -34,38 +87,146 @@ class ScraperWikiScraper(NewsItemListDetailScraper):
         self.num_added = 0
         self.num_changed = 0
         self.num_skipped = 0
+        # Incremental runs only ask for rows at or past the high-water mark
+        # left by the previous batch; --full (or --clear) resyncs everything.
+        self.since = None
+        if self.keyset and not (full or clear):
+            self.since = self.last_high_water()
+        self.high_water = self.since
+        self._page_high_water = None
+        self._existing = {}
+        self._current_key = None
+        self.writer = NewsItemWriter()
         self.batch = \
             error_log.GeocodeBatch.objects.create(scraper=self.schema_slugs[0])
         self.geocode_log = None
-        if self.geocoder_type == 'google':
-            from openrural.retrieval.geocoders import GoogleGeocoder
-            self._geocoder = GoogleGeocoder()
+        # exception name: number of geocodes that failed with it
+        self.geocode_failures = {}
+        if self.geocoder_type is None:
+            self._geocoder = get_shared_geocoder()
+        else:
+            self._geocoder = make_geocoder(self.geocoder_type)
+        self._geocode_memo = GeocodeMemo(self._geocoder)
+        # the geocoder may be shared by the whole process
+        self._cache_counts_start = self._cache_counts()
+
+    def _cache_counts(self):
+        """
+        Returns the hits and misses so far of the geocoder's result cache
+        (e.g. GoogleGeocoder's CachedGeocode table), or zeros if it has
+        none. The in-memory cache of a CachingGeocoder isn't counted.
+        """
+        geocoder = self._geocoder
+        if isinstance(geocoder, CachingGeocoder):
+            geocoder = geocoder.geocoder
+        return getattr(geocoder, 'hits', 0), getattr(geocoder, 'misses', 0)
+
+    def last_high_water(self):
+        """
+        Returns the keyset value reached by the most recent batch of this
+        scraper, or None if no batch has recorded one.
+        """
+        batches = error_log.GeocodeBatch.objects.filter(
+            scraper=self.schema_slugs[0]).exclude(high_water='')
+        try:
+            batch = batches.order_by('-start_time')[0]
+        except IndexError:
+            return None
+        return json.loads(batch.high_water)
+
+    def quote(self, value):
+        if isinstance(value, (int, long, float)):
+            return str(value)
+        return "'{0}'".format(unicode(value).replace("'", "''"))
+
+    def keyset_where(self, after):
+        """
+        Returns the WHERE clause selecting rows that sort after ``after``,
+        a (keyset value, rowid) tuple taken from the last row of a page.
+        """
+        value, rowid = after
+        if self.keyset == 'rowid':
+            return 'rowid > {0}'.format(self.quote(rowid))
+        return '({0} > {1} OR ({0} = {1} AND rowid > {2}))'.format(
+            self.keyset, self.quote(value), self.quote(rowid))
 
-    def get_query(self, select='*', limit=10, offset=0):
-        where = ''
+    def get_query(self, select='*', limit=10, offset=0, after=None,
+                  nulls=None):
+        """
+        ``nulls`` restricts keyset queries to the rows whose keyset value is
+        NULL (True), or isn't (False).
+        """
+        parts = []
         if self.list_filter:
-            parts = []
             for key, val in self.list_filter.iteritems():
                 parts.append("{0} = '{1}'".format(key, val))
-            where = ' AND '.join(parts)
+        if nulls is not None:
+            parts.append('{0} IS {1}NULL'.format(self.keyset,
+                                                 '' if nulls else 'NOT '))
+        if self.since is not None and not nulls:
+            # Rows sharing the mark's value are fetched again; they're
+            # skipped as existing records.
+            parts.append('{0} >= {1}'.format(self.keyset,
+                                             self.quote(self.since)))
+        if after is not None:
+            if nulls:
+                parts.append('rowid > {0}'.format(self.quote(after[1])))
+            else:
+                parts.append(self.keyset_where(after))
+        where = ' AND '.join(parts)
         query = ['SELECT {0} FROM `swdata`'.format(select)]
         if where:
             query.append('WHERE {0}'.format(where))
-        if self.ordering:
+        if self.keyset and nulls and limit > 0:
+            query.append('ORDER BY rowid ASC')
+        elif self.keyset and limit > 0:
+            query.append('ORDER BY {0}'.format(self.keyset_ordering()))
+        elif self.ordering:
             query.append('ORDER BY {0}'.format(self.ordering))
         if limit > 0:
             query.append('LIMIT {0}'.format(limit))
         if offset > 0:
             query.append('OFFSET {0}'.format(offset))
         query = ' '.join(query)
-        self.logger.debug(query)
+        self.logger.debug('%s', query)
         return query
 
+    def get_html(self, *args, **kwargs):
+        # httplib2 connections aren't thread safe, so each prefetch worker
+        # downloads through a Retriever of its own.
+        retriever = getattr(self._fetch_local, 'retriever', None)
+        if retriever is None:
+            return super(ScraperWikiScraper, self).get_html(*args, **kwargs)
+        return retriever.fetch_data(*args, **kwargs)
+
+    def _init_fetch_worker(self):
+        if not self.use_cache:
+            retriever = Retriever(cache=None, sleep=self.sleep,
+                                  timeout=self.timeout)
+        else:
+            retriever = Retriever(sleep=self.sleep, timeout=self.timeout)
+        self._fetch_local.retriever = retriever
+
+    def fetch_pool(self):
+        if self.fetch_workers > 1:
+            return ThreadPool(self.fetch_workers,
+                              initializer=self._init_fetch_worker)
+        return None
+
+    def fetch(self, pool, query):
+        """
+        Starts downloading the page for ``query`` and returns an object
+        whose ``get()`` method returns the page data.
+        """
+        if pool is None:
+            return Deferred(self.get_url, query)
+        return pool.apply_async(self.get_url, (query,))
+
     def get_url(self, query):
         args = {'name': self.scraper_name, "format": "jsondict",
                 "query": query}
         url = "{0}?{1}".format(self.url, urllib.urlencode(args))
-        self.logger.info(url)
+        self.logger.info('%s', url)
         return self.get_html(url)
 
     def count(self):
@@ -73,26 +234,242 @@ class ScraperWikiScraper(NewsItemListDetailScraper):
         data = json.loads(self.get_url(query=query))[0]
         return data['count']
 
+    def keyset_ordering(self):
+        if self.keyset == 'rowid':
+            return 'rowid ASC'
+        return '{0} ASC, rowid ASC'.format(self.keyset)
+
     def list_pages(self):
+        if self.keyset:
+            return self.keyset_pages()
+        return self.offset_pages()
+
+    def offset_pages(self):
         count = self.count()
+        queue_size = self.fetch_queue or 2 * self.fetch_workers
+        pool = self.fetch_pool()
+        pending = deque()
         offset = 0
-        while offset < count:
-            yield self.get_url(query=self.get_query(limit=self.limit, offset=offset))
-            offset += self.limit
+        try:
+            while offset < count or pending:
+                # keep the queue topped up, then hand pages out in order
+                while offset < count and len(pending) < queue_size:
+                    query = self.get_query(limit=self.limit, offset=offset)
+                    pending.append(self.fetch(pool, query))
+                    offset += self.limit
+                yield pending.popleft().get()
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def keyset_pages(self):
+        """
+        Walks the datastore in keyset order, seeking past the last row of
+        the previous page rather than counting rows with OFFSET.  Rows
+        appended during the run are picked up as long as they sort after
+        the current position.
+
+        Each page names the start of the next one, so at most one page is
+        fetched ahead, while the current page is being saved.  Rows with a
+        NULL keyset value follow, read again on every run.
+        """
+        pool = self.fetch_pool()
+        try:
+            if self.keyset == 'rowid':
+                passes = (None, )
+            else:
+                passes = (False, True)
+            for nulls in passes:
+                for data in self._seek_pages(pool, nulls):
+                    yield data
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def _seek_pages(self, pool, nulls):
+        select = 'rowid AS {0}, *'.format(ROWID)
+        query = self.get_query(select=select, limit=self.limit, nulls=nulls)
+        pending = self.fetch(pool, query)
+        while pending is not None:
+            data = pending.get()
+            rows = json.loads(data)
+            pending = None
+            if len(rows) == self.limit:
+                last = rows[-1]
+                after = (last.get(self.keyset), last[ROWID])
+                query = self.get_query(select=select, limit=self.limit,
+                                       after=after, nulls=nulls)
+                pending = self.fetch(pool, query)
+            if rows:
+                yield data
 
     def parse_list(self, data):
+        rows = []
         for row in json.loads(data):
+            rowid = row.pop(ROWID, None)
+            if self.keyset == 'rowid':
+                self._page_high_water = rowid
+            elif self.keyset and row.get(self.keyset) is not None:
+                self._page_high_water = row.get(self.keyset)
+            try:
+                key = self.record_key(row)
+            except (KeyError, TypeError, ValueError), e:
+                self.logger.warning('Skipping row %s, it has no valid key: '
+                                    '%s', rowid, e)
+                self.batch.num += 1
+                self.num_skipped += 1
+                continue
+            rows.append((row, key))
+        self._existing = self.existing_records([key for row, key in rows])
+        if self.geocode_pool is not None:
+            # existing records aren't geocoded again
+            locations = [self.geocode_location(row) for row, key in rows
+                         if key not in self._existing]
+            self._geocode_memo.prefetch([l for l in locations if l],
+                                        self.geocode_pool)
+        for row, key in rows:
             self.batch.num += 1
             self.geocode_log = None
+            self._current_key = key
             yield row
 
+    def record_key(self, record):
+        """
+        Returns the value of ``key_field`` for the given raw row, as it is
+        stored in the NewsItem's attributes.  Rows for which it raises
+        KeyError, TypeError or ValueError are skipped.
+
+        Subclasses must override this.
+        """
+        raise NotImplementedError()
+
+    def geocode_location(self, record):
+        """
+        Returns the (location_name, zipcode) save() will geocode for this
+        row, or None.  Used to geocode a page's addresses in parallel;
+        subclasses that don't override it are geocoded row by row.
+        """
+        return None
+
+    def existing_records(self, keys):
+        """
+        Resolves the keys of a whole page of rows to existing NewsItems
+        with a single query, returning a {key: NewsItem} dictionary.
+        """
+        keys = list(set(keys))
+        if not keys:
+            return {}
+        field = self.schema_fields[self.key_field]
+        qs = NewsItem.objects.filter(schema__id=self.schema.id)
+        qs = qs.by_attribute(field, keys)
+        qs = qs.extra(select={
+            'record_key': 'db_attribute.{0}'.format(field.real_name),
+        })
+        existing = {}
+        for news_item in qs:
+            existing.setdefault(news_item.record_key, news_item)
+        return existing
+
+    def existing_record(self, record):
+        news_item = self._existing.get(self._current_key)
+        if news_item is not None and news_item.pk is None:
+            # created earlier in this page, but still buffered
+            self.flush()
+        return news_item
+
+    def flush(self):
+        """Writes the NewsItems buffered so far."""
+        try:
+            saved = self.writer.flush()
+        except IntegrityError:
+            # A Traceback cached by this process may have been pruned
+            # since; look those up again and retry once.
+            if not self._refresh_tracebacks():
+                raise
+            saved = self.writer.flush()
+        for news_item in saved:
+            self.num_added += 1
+            self.logger.info(u'Created NewsItem %s: %s (total created in '
+                             'this scrape: %s)', news_item.schema.slug,
+                             news_item.id, self.num_added)
+
+    def _refresh_tracebacks(self):
+        """
+        Resolves the Tracebacks of the buffered Geocodes again, bypassing
+        the cache. Returns whether there were any.
+        """
+        error_log.Traceback.objects.forget()
+        refreshed = False
+        for news_item, attributes, related in self.writer.pending:
+            for obj in related:
+                text = getattr(obj, 'traceback_text', None)
+                if text:
+                    obj.traceback_id = \
+                        error_log.Traceback.objects.for_text(text)
+                    refreshed = True
+        return refreshed
+
+    def _flush_after_error(self):
+        """
+        Like flush(), but logs a failed write instead of raising it, so
+        the error that stopped the scrape is the one that propagates.
+        """
+        try:
+            self.flush()
+        except Exception:
+            self.logger.exception(u'Could not write the buffered NewsItems')
+
+    def update_from_string(self, page):
+        self._page_high_water = None
+        try:
+            super(ScraperWikiScraper, self).update_from_string(page)
+        except:
+            # write the page's items even if a later row blew up, but
+            # leave the high-water mark so the page is read again
+            exc_info = sys.exc_info()
+            self._flush_after_error()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.flush()
+        # Keyset pages arrive in ascending order, so once a page has been
+        # saved its last row is the new high-water mark.
+        if self._page_high_water is not None:
+            self.high_water = self._page_high_water
+
     def update(self):
-        super(ScraperWikiScraper, self).update()
+        if self.geocode_workers > 1:
+            self.geocode_pool = GeocoderPool(self.geocode_workers,
+                                             type(self._geocoder))
+        failed = True
+        try:
+            super(ScraperWikiScraper, self).update()
+            failed = False
+        finally:
+            try:
+                if self.geocode_pool is not None:
+                    self.geocode_pool.close()
+                    self.geocode_pool = None
+                if failed:
+                    self._flush_after_error()
+                else:
+                    self.flush()
+            finally:
+                # record the batch even if the last write failed
+                self._save_batch()
+
+    def _save_batch(self):
+        """Saves the batch's counters and rolls up its geocode failures."""
         self.batch.end_time = datetime.datetime.now()
         self.batch.num_added = self.num_added
         self.batch.num_changed = self.num_changed
         self.batch.num_skipped = self.num_skipped
+        hits, misses = self._cache_counts()
+        self.batch.num_cache_hits = hits - self._cache_counts_start[0]
+        self.batch.num_cache_misses = misses - self._cache_counts_start[1]
+        self.batch.num_memo_hits = self._geocode_memo.hits
+        if self.high_water is not None:
+            self.batch.high_water = json.dumps(self.high_water)
         self.batch.save()
+        error_log.GeocodeStats.objects.add(self.batch, self.geocode_failures)
 
     def geocode(self, location_name, zipcode=None):
         """
@@ -113,39 +490,82 @@ class ScraperWikiScraper(NewsItemListDetailScraper):
         # legitimate nearby zipcode identified in either the address
         # or street number data.
         try:
-            loc = self._geocoder.geocode(location_name)
+            loc = self._geocode_memo.geocode(location_name, zipcode)
             self.batch.num_geocoded_success += 1
             return loc
         except AmbiguousResult as result:
             # try to resolve based on zipcode...
             if zipcode is None:
                 self.logger.info(
-                    "Ambiguous results for address %s. (no zipcode to resolve dispute)" %
-                    (location_name, ))
+                    "Ambiguous results for address %s. (no zipcode to resolve dispute)",
+                    location_name)
                 return None
             in_zip = [r for r in result.choices if r['zip'] == zipcode]
             if len(in_zip) == 0:
                 self.logger.info(
-                    "Ambiguous results for address %s, but none in specified zipcode %s" %
-                    (location_name, zipcode))
+                    "Ambiguous results for address %s, but none in specified zipcode %s",
+                    location_name, zipcode)
                 return None
             elif len(in_zip) > 1:
                 self.logger.info(
-                    "Ambiguous results for address %s in zipcode %s, guessing first." %
-                    (location_name, zipcode))
+                    "Ambiguous results for address %s in zipcode %s, guessing first.",
+                    location_name, zipcode)
                 return in_zip[0]
             else:
                 return in_zip[0]
         except (GeocodingException, ParsingError, NoReverseMatch) as e:
             self.geocode_log.success = False
             self.geocode_log.name = type(e).__name__
-            self.geocode_log.description = traceback.format_exc()
-            self.logger.error(unicode(e))
+            self.geocode_failures[self.geocode_log.name] = \
+                self.geocode_failures.get(self.geocode_log.name, 0) + 1
+            stack, summary = error_log.split_traceback(
+                getattr(e, 'geocode_traceback', None) or traceback.format_exc())
+            self.geocode_log.description = summary
+            if stack:
+                self.geocode_log.traceback_id = \
+                    error_log.Traceback.objects.for_text(stack)
+                # kept to look the id up again, see flush()
+                self.geocode_log.traceback_text = stack
+            self.logger.error(u'%s', e)
             return None
 
     def create_newsitem(self, attributes, **kwargs):
-        news_item = super(ScraperWikiScraper, self).create_newsitem(attributes,
-                                                                    **kwargs)
-        self.geocode_log.news_item = news_item
-        self.geocode_log.save()
+        """
+        Like BaseScraper.create_newsitem(), but the new NewsItem, its
+        attributes and its Geocode log row are buffered and written along
+        with the rest of the page (see flush()).  Returns the NewsItem,
+        which has no id until then.
+        """
+        location = kwargs.get('location')
+        location_name = kwargs.get('location_name')
+        assert location or location_name, \
+            "At least one of location or location_name must be provided"
+        if location is None:
+            location = self.geocode(location_name, zipcode=kwargs.get('zipcode'))
+            if location:
+                location = location['point']
+        if kwargs.pop('convert_to_block', False):
+            kwargs['location_name'] = address_to_block(location_name)
+            if location is None:
+                location = self.geocode(kwargs['location_name'],
+                                        zipcode=kwargs.get('zipcode'))
+                if location:
+                    location = location['point']
+        news_item = NewsItem(
+            schema=kwargs.get('schema', None) or self.schema,
+            title=kwargs['title'],
+            description=kwargs.get('description', ''),
+            url=kwargs.get('url', ''),
+            pub_date=kwargs.get('pub_date', self.start_time),
+            item_date=kwargs['item_date'],
+            location=location,
+            location_name=location_name,
+            location_object=kwargs.get('location_object', None),
+        )
+        related = []
+        if self.geocode_log is not None:
+            related.append(self.geocode_log)
+        self.writer.add(news_item, attributes, related)
+        # later rows in this page with the same key update this item
+        self._existing[self._current_key] = news_item
         return news_item
@@ -0,0 +1,286 @@
+"""
+An in-memory geocoder backend for small (e.g. rural county) metros.
+
+The metro's blocks, intersections and street misspellings are loaded into
+dictionaries once per process and geocode() answers from them without
+touching PostGIS.  Anything the index can't find falls back to the regular
+SQL-backed SmartGeocoder.
+
+The index reloads itself after ``import_county_streets`` has run (see
+street_index_changed()).
+"""
+
+import re
+import math
+import time
+import logging
+
+from django.core.cache import cache
+from django.contrib.gis.geos import Point
+
+from ebpub.geocoder import SmartGeocoder, AddressGeocoder, BlockGeocoder, \
+    IntersectionGeocoder, DoesNotExist, AmbiguousResult
+from ebpub.geocoder.base import block_re, intersection_re
+from ebpub.geocoder.parser.parsing import parse
+from ebpub.streets.models import Block, Intersection, StreetMisspelling
+from ebpub.utils.geodjango import get_default_bounds
+
+
+__all__ = ('StreetIndex', 'MemoryGeocoder', 'get_street_index',
+           'street_index_changed')
+
+
+logger = logging.getLogger('openrural.retrieval.streetindex')
+
+VERSION_KEY = 'openrural.streetindex.version'
+# How often (in seconds) a loaded index checks whether it is stale.
+CHECK_INTERVAL = 60
+
+
+def street_index_changed():
+    """
+    Tells every process's street index to reload, and shared geocoders to
+    forget their results; call this after changing the blocks or
+    intersections tables.
+    """
+    # geocoders imports this module
+    from openrural.retrieval.geocoders import clear_shared_geocoder
+    cache.set(VERSION_KEY, time.time(), 60 * 60 * 24 * 365)
+    _index.checked = 0
+    clear_shared_geocoder()
+
+
+def interpolate(line, fraction):
+    """
+    Returns the Point ``fraction`` of the way along ``line``, measured in
+    the line's own coordinates like PostGIS' line_interpolate_point().
+    """
+    coords = line.coords
+    fraction = min(max(fraction, 0.0), 1.0)
+    lengths = []
+    for (x0, y0), (x1, y1) in zip(coords, coords[1:]):
+        lengths.append(math.hypot(x1 - x0, y1 - y0))
+    remaining = sum(lengths) * fraction
+    for i, length in enumerate(lengths):
+        if remaining <= length and length > 0:
+            x0, y0 = coords[i]
+            x1, y1 = coords[i + 1]
+            ratio = remaining / length
+            return Point(x0 + (x1 - x0) * ratio, y0 + (y1 - y0) * ratio,
+                         srid=line.srid)
+        remaining -= length
+    x, y = coords[-1]
+    return Point(x, y, srid=line.srid)
+
+
+class StreetIndex(object):
+    """
+    The metro's blocks indexed by street name, and its intersections by
+    pair of street names.
+    """
+
+    def __init__(self):
+        self.blocks = {}
+        self.intersections = {}
+        self.misspellings = {}
+        self.loaded = False
+        self.version = None
+        self.checked = 0
+
+    def load(self):
+        start = time.time()
+        version = cache.get(VERSION_KEY)
+        bounds = get_default_bounds()
+        blocks = {}
+        for block in Block.objects.filter(geom__intersects=bounds):
+            blocks.setdefault(block.street, []).append(block)
+        intersections = {}
+        qs = Intersection.objects.filter(location__intersects=bounds)
+        for intersection in qs:
+            a, b = intersection.street_a, intersection.street_b
+            intersections.setdefault((a, b), []).append((intersection, False))
+            if a != b:
+                intersections.setdefault((b, a), []).append((intersection, True))
+        self.misspellings = dict(
+            StreetMisspelling.objects.values_list('incorrect', 'correct'))
+        self.blocks = blocks
+        self.intersections = intersections
+        self.loaded = True
+        self.version = version
+        self.checked = time.time()
+        logger.info('Loaded %d streets and %d intersections in %.1fs',
+                    len(blocks), len(qs), time.time() - start)
+
+    def refresh(self):
+        """Loads the index, or reloads it if the streets have changed."""
+        now = time.time()
+        if self.loaded and now - self.checked < CHECK_INTERVAL:
+            return
+        self.checked = now
+        if not self.loaded or cache.get(VERSION_KEY) != self.version:
+            self.load()
+
+    def correct(self, street):
+        street = ' '.join(street.upper().strip().split())
+        return self.misspellings.get(street, street)
+
+    def search_blocks(self, street, number, predir=None, suffix=None,
+                      postdir=None, city=None, state=None, zipcode=None):
+        """
+        Like Block.objects.search(), returns (block, geocoded point) pairs
+        for the blocks containing the given address.
+        """
+        number = int(re.sub(r'\D', '', number))
+        results = []
+        for block in self.blocks.get(street.upper(), ()):
+            if predir and block.predir != predir.upper():
+                continue
+            if suffix and block.suffix != suffix.upper():
+                continue
+            if postdir and block.postdir != postdir.upper():
+                continue
+            if city and city.upper() not in (block.left_city, block.right_city):
+                continue
+            if state and state.upper() not in (block.left_state,
+                                               block.right_state):
+                continue
+            if zipcode and zipcode not in (block.left_zip, block.right_zip):
+                continue
+            if block.from_num is None or block.to_num is None or \
+                    not block.from_num <= number <= block.to_num:
+                continue
+            contains, from_num, to_num = block.contains_number(number)
+            if not contains:
+                continue
+            try:
+                fraction = (float(number) - from_num) / (to_num - from_num)
+            except ZeroDivisionError:
+                fraction = 0.5
+            results.append((block, interpolate(block.geom, fraction)))
+        return results
+
+    def search_intersections(self, street_a, street_b):
+        """
+        Returns the intersections of two parsed locations, matching the
+        streets in either order like Intersection.objects.search().
+        """
+        results = []
+        key = (street_a['street'].upper(), street_b['street'].upper())
+        for intersection, swapped in self.intersections.get(key, ()):
+            sides = [('a', street_a), ('b', street_b)]
+            if swapped:
+                sides = [('b', street_a), ('a', street_b)]
+            for side, loc in sides:
+                if loc['pre_dir'] and getattr(intersection, 'predir_' + side) \
+                        != loc['pre_dir'].upper():
+                    break
+                if loc['suffix'] and getattr(intersection, 'suffix_' + side) \
+                        != loc['suffix'].upper():
+                    break
+                if loc['post_dir'] and getattr(intersection, 'postdir_' + side) \
+                        != loc['post_dir'].upper():
+                    break
+            else:
+                results.append(intersection)
+        return results
+
+
+_index = StreetIndex()
+
+
+def get_street_index():
+    """Returns this process's StreetIndex, loading it on first use."""
+    _index.refresh()
+    return _index
+
+
+class MemoryAddressGeocoder(AddressGeocoder):
+
+    def __init__(self, index):
+        super(MemoryAddressGeocoder, self).__init__(use_cache=False)
+        self.index = index
+
+    def _db_lookup(self, location):
+        if not location['number']:
+            return []
+        blocks = self.index.search_blocks(
+            street=location['street'],
+            number=location['number'],
+            predir=location['pre_dir'],
+            suffix=location['suffix'],
+            postdir=location['post_dir'],
+            city=location['city'],
+            state=location['state'],
+            zipcode=location['zip'],
+        )
+        return [self._build_result(location, block, geocoded_pt)
+                for block, geocoded_pt in blocks]
+
+
+class MemoryBlockGeocoder(BlockGeocoder, MemoryAddressGeocoder):
+    pass
+
+
+class MemoryIntersectionGeocoder(IntersectionGeocoder):
+
+    def __init__(self, index):
+        super(MemoryIntersectionGeocoder, self).__init__(use_cache=False)
+        self.index = index
+
+    def _do_geocode(self, location_string):
+        # IntersectionGeocoder._do_geocode, correcting misspellings from
+        # the index instead of the database
+        sides = intersection_re.split(location_string)
+        if len(sides) != 2:
+            return super(MemoryIntersectionGeocoder, self)._do_geocode(
+                location_string)
+        left_side = parse(sides[0])
+        right_side = parse(sides[1])
+        all_results = []
+        seen_intersections = set()
+        for street_a in left_side:
+            street_a['street'] = self.index.correct(street_a['street'])
+            for street_b in right_side:
+                street_b['street'] = self.index.correct(street_b['street'])
+                for result in self._db_lookup(street_a, street_b):
+                    if result['intersection_id'] not in seen_intersections:
+                        seen_intersections.add(result['intersection_id'])
+                        all_results.append(result)
+        if not all_results:
+            raise DoesNotExist("Street index couldn't find this "
+                               "intersection: %r" % location_string)
+        elif len(all_results) == 1:
+            return all_results.pop()
+        else:
+            raise AmbiguousResult(list(all_results),
+                                  "Street index returned %s results" %
+                                  len(all_results))
+
+    def _db_lookup(self, street_a, street_b):
+        return [self._build_result(i)
+                for i in self.index.search_intersections(street_a, street_b)]
+
+
+class MemoryGeocoder(SmartGeocoder):
+    """
+    A SmartGeocoder answering from the in-memory StreetIndex, falling back
+    to the database when the index has no match.
+    """
+
+    def __init__(self, use_cache=False):
+        super(MemoryGeocoder, self).__init__(use_cache=use_cache)
+
+    def _do_geocode(self, location_string):
+        index = get_street_index()
+        if intersection_re.search(location_string):
+            geocoder = MemoryIntersectionGeocoder(index)
+        elif block_re.search(location_string):
+            geocoder = MemoryBlockGeocoder(index)
+        else:
+            geocoder = MemoryAddressGeocoder(index)
+        try:
+            return geocoder._do_geocode(location_string)
+        except DoesNotExist:
+            logger.debug('%r not in street index, trying the database' %
+                         location_string)
+            return super(MemoryGeocoder, self)._do_geocode(location_string)
@@ -1,18 +1,29 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import csv
+import json
 import logging
 import datetime
+import multiprocessing
+from collections import deque
+from itertools import islice
 from optparse import OptionParser
-from collections import defaultdict
 
+from django.db import connection, transaction
 from django.contrib.gis.gdal import DataSource
 
 from ebpub.db.models import NewsItem, Schema, SchemaField
 from ebdata.retrieval.scrapers.base import BaseScraper
 from ebpub.utils.script_utils import add_verbosity_options, setup_logging_from_opts
 
+from openrural.dbfcache import DBF, decode
+from openrural.retrieval.fingerprints import FingerprintSet, row_digest, \
+    NEW, UNCHANGED
+from openrural.retrieval.parcels import PARCEL_INDEXES, SqliteParcelIndex, \
+    PropSet, peak_rss
+
 logger = logging.getLogger('openrural.retrieval.whiteville_resturants')
 
 class PropertyTransactions(BaseScraper):
@@ -25,15 +36,146 @@ class PropertyTransactions(BaseScraper):
             self._create_schema()
         self.schema = Schema.objects.get(slug=self.schema_slug)
         self.num_added = 0
-
-    def update(self, csvreader, layer):
-        feature_by_prop = {}
-        for feature in layer:
-            feature_by_prop[int(feature.get('PROP'))] = feature
-
-        for item in csvreader:
-            item_date = self.parse_date(item['SaleDate'])
-            feature = feature_by_prop.get(int(item['Prop']))
+        self.num_changed = 0
+        self.num_unchanged = 0
+        self.num_skipped = 0
+        self.date_errors = []
+
+    def update(self, csvreader, layer, parcel_index='memory', workers=1,
+               chunk_size=5000):
+        """
+        Imports the rows of ``csvreader`` that are new or changed since the
+        last import, ``chunk_size`` rows per transaction.
+        """
+        if workers > 1:
+            # workers share one index file
+            parcel_index = 'sqlite'
+        parcels = PARCEL_INDEXES[parcel_index](layer)
+        self.logger.info('Indexed %d parcels, peak RSS %d KB', len(parcels),
+                         peak_rss())
+        try:
+            if workers > 1:
+                self._update_parallel(csvreader, parcels.path, workers,
+                                      chunk_size)
+            else:
+                start = 0
+                for rows in iter(lambda: list(islice(csvreader, chunk_size)),
+                                 []):
+                    self.import_chunk(rows, parcels, start)
+                    start += len(rows)
+        finally:
+            parcels.close()
+        self.logger.info('Created %d items, changed %d, %d unchanged, skipped '
+                         '%d rows, peak RSS %d KB', self.num_added,
+                         self.num_changed, self.num_unchanged,
+                         self.num_skipped, peak_rss())
+        if self.date_errors:
+            self.logger.warning('%d rows have unparseable sale dates, e.g. '
+                                '%s', len(self.date_errors), ', '.join(
+                                    ['row %s: %r' % error for error in
+                                     sorted(self.date_errors)[:10]]))
+
+    def _update_parallel(self, csvreader, parcel_path, workers, chunk_size):
+        """
+        Imports the CSV in chunks of ``chunk_size`` rows on ``workers``
+        processes, each looking parcels up in the sqlite index at
+        ``parcel_path`` and saving a chunk in one transaction.
+        """
+        chunks = iter(lambda: list(islice(csvreader, chunk_size)), [])
+        jobs = ((i * chunk_size, rows) for i, rows in enumerate(chunks))
+        # workers mustn't share the parent's connection
+        connection.close()
+        pool = multiprocessing.Pool(workers, _init_worker, (parcel_path,))
+        # Only a few chunks are read ahead: Pool would otherwise read the
+        # whole CSV into its task queue.
+        pending = deque()
+        try:
+            while True:
+                for job in islice(jobs, workers * 2 - len(pending)):
+                    pending.append(pool.apply_async(_import_chunk, (job,)))
+                if not pending:
+                    break
+                start, num_rows, counts, date_errors = pending.popleft().get()
+                num_added, num_changed, num_unchanged, num_skipped = counts
+                self.num_added += num_added
+                self.num_changed += num_changed
+                self.num_unchanged += num_unchanged
+                self.num_skipped += num_skipped
+                self.date_errors.extend(date_errors)
+                self.logger.info('Rows %d-%d: created %d items, changed %d',
+                                 start, start + num_rows - 1, num_added,
+                                 num_changed)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def row_key(self, item):
+        """The natural key of a CSV row: its property and sale date."""
+        return '%s:%s' % (item['Prop'], item['SaleDate'])
+
+    def import_chunk(self, rows, parcels, start=0):
+        """
+        Saves the NewsItems of the new and changed ``rows`` in a single
+        transaction, returning the numbers of items created and changed,
+        of unchanged rows and of rows skipped.
+        """
+        before = (self.num_added, self.num_changed, self.num_unchanged,
+                  self.num_skipped)
+        fingerprints = FingerprintSet(self.schema,
+                                      [self.row_key(item) for item in rows])
+        # Workers claim keys in the same order, so two chunks sharing keys
+        # wait for each other instead of deadlocking.
+        rows = sorted(enumerate(rows, start),
+                      key=lambda row: self.row_key(row[1]))
+        with transaction.commit_on_success():
+            for key, digest, attrs, kwargs in self._items(rows, parcels):
+                status, fingerprint = fingerprints.status(key, digest,
+                                                          claim=True)
+                if status == UNCHANGED:
+                    self.num_unchanged += 1
+                    continue
+                # create_newsitem() and update_existing() would commit each
+                # item on its own
+                if status == NEW:
+                    news_item = self._save_newsitem(attrs, **kwargs)
+                    self.num_added += 1
+                else:
+                    news_item = self._save_newsitem(
+                        attrs, news_item=fingerprint.news_item, **kwargs)
+                    self.num_changed += 1
+                fingerprints.save(key, digest, news_item)
+        after = (self.num_added, self.num_changed, self.num_unchanged,
+                 self.num_skipped)
+        return tuple([a - b for a, b in zip(after, before)])
+
+    def _save_newsitem(self, attributes, news_item=None, **kwargs):
+        """
+        Saves a new NewsItem, or ``news_item`` with new values, without a
+        transaction of its own.
+        """
+        if news_item is None:
+            news_item = NewsItem(schema=self.schema, pub_date=self.start_time)
+        news_item.title = kwargs['title']
+        news_item.url = kwargs['url']
+        news_item.item_date = kwargs['item_date']
+        news_item.location = kwargs['location']
+        news_item.location_name = kwargs['location_name']
+        news_item.save()
+        news_item.attributes = attributes
+        return news_item
+
+    def _items(self, rows, parcels):
+        """
+        Yields (key, digest, attributes, create_newsitem() kwargs) for the
+        (row number, row) pairs with a sale date and a parcel. The digest
+        covers the row and its parcel.
+        """
+        for rownum, item in rows:
+            item_date = self.parse_date(item['SaleDate'], rownum=rownum)
+            parcel = parcels.get(int(item['Prop']))
 
             owner_address = item['Address1']
             for i in range(2, 4):
@@ -42,7 +184,7 @@ class PropertyTransactions(BaseScraper):
                     owner_address = '%s / %s' % (owner_address, item_field)
             owner_address = '%s %s' % (owner_address, item['ZipCode'])
 
-            if item_date and feature:
+            if item_date and parcel:
                 attrs = {
                     'pin': item['PIN'],
                     'owner_name': item['Owner'],
@@ -52,39 +194,57 @@ class PropertyTransactions(BaseScraper):
                     'total_val': int(item['TotalVal']),
                     'sale_amt': int(item['SaleAmt']),
                     'year_built': int(item['YrBlt']),
-                    'prop_card': str(feature['PROPCARD']),
+                    'prop_card': str(parcel.propcard),
                 }
-                location_name = '%s %s %s' % (feature['FULLADD'], feature['CITY'], feature['ZIP'])
-                self.create_newsitem(
-                    attrs,
+                location_name = '%s %s %s' % (parcel.fulladd, parcel.city, parcel.zip)
+                digest = row_digest(sorted(item.items()) + list(parcel))
+                yield self.row_key(item), digest, attrs, dict(
                     title='Property %s' % item['Prop'],
-                    url=feature['PHOTO_URL'],
+                    url=parcel.photo_url,
                     item_date=item_date,
-                    location=feature.geom.transform(4326, True).geos,
+                    location=parcel.geom,
                     location_name=location_name.strip(),
                     zipcode=item['ZipCode']
                 )
+            else:
+                self.num_skipped += 1
+
+    def stats(self, csvreader, dbf_path):
+        """
+        Profiles a CSV file and the .dbf of its parcel shapefile in one pass
+        each, keeping only bitmaps of their PROP numbers, and returns the
+        counts as a dictionary.
+        """
+        dbf = DBF(dbf_path)
+        try:
+            name, typ, offset, size, deci = dbf.field('PROP')
+            feature_count = 0
+            blank_prop_count = 0
+            feature_props = PropSet()
+            multi_feature_props = PropSet()
+            for key, recno in dbf.keys((name, typ, offset, size, deci)):
+                feature_count += 1
+                if not key:
+                    blank_prop_count += 1
+                    continue
+                # e.g. '123.000' in a numeric field with decimals
+                propval = int(decode(typ, deci, key))
+                if not feature_props.add(propval):
+                    multi_feature_props.add(propval)
+        finally:
+            dbf.close()
 
-    def stats(self, csvreader, layer):
-        feature_by_prop = defaultdict(list)
-        feature_count = len(layer)
-        for feature in layer:
-            propval = int(feature.get('PROP'))
-            feature_by_prop[propval].append(feature)
-
-        import pdb; pdb.set_trace()
         zero_date_count = 0
         invalid_date_count = 0
-        props_missing_from_shapefile = 0
         item_count = 0
         valid_date_but_no_feature = 0
         valid_date_but_multi_feature = 0
         valid_date_and_single_feature = 0
-        item_by_prop = defaultdict(list)
+        item_props = PropSet()
         for rownum, item in enumerate(csvreader):
             item_count += 1
             propval = int(item['Prop'])
-            item_by_prop[propval].append(item)
+            item_props.add(propval)
             item_date = item['SaleDate']
             if item_date == '0':
                 zero_date_count += 1
@@ -95,39 +255,47 @@ class PropertyTransactions(BaseScraper):
                     invalid_date_count += 1
 
             if item_date:
-                if propval not in feature_by_prop:
+                if propval not in feature_props:
                     valid_date_but_no_feature += 1
+                elif propval in multi_feature_props:
+                    valid_date_but_multi_feature += 1
                 else:
-                    features = feature_by_prop[propval]
-                    if len(features) == 1:
-                        valid_date_and_single_feature += 1
-                    else:
-                        valid_date_but_multi_feature += 1
-
-        csv_props_missing_from_shapefile = []
-        for k in item_by_prop.keys():
-            if k not in feature_by_prop:
-                csv_props_missing_from_shapefile.append(k)
-
-        shapefile_props_missing_from_csv = []
-        for k in feature_by_prop.keys():
-            if k not in item_by_prop:
-                shapefile_props_missing_from_csv.append(k)
-
-        self.logger.info('Shapefile has %s features with %s distinct properties.', feature_count, len(feature_by_prop))
-        self.logger.info('CSV file has %s rows, with %s distinct properties.', item_count, len(item_by_prop))
-        self.logger.info('CSV file has %s "0" dates, and %s invalid dates.', zero_date_count, invalid_date_count)
+                    valid_date_and_single_feature += 1
+
+        both = item_props.intersection_count(feature_props)
+        return {
+            'feature_count': feature_count,
+            'blank_prop_count': blank_prop_count,
+            'feature_props': len(feature_props),
+            'multi_feature_props': len(multi_feature_props),
+            'item_count': item_count,
+            'item_props': len(item_props),
+            'zero_date_count': zero_date_count,
+            'invalid_date_count': invalid_date_count,
+            'csv_props_missing_from_shapefile': len(item_props) - both,
+            'shapefile_props_missing_from_csv': len(feature_props) - both,
+            'valid_date_count':
+                item_count - invalid_date_count - zero_date_count,
+            'valid_date_but_no_feature': valid_date_but_no_feature,
+            'valid_date_but_multi_feature': valid_date_but_multi_feature,
+            'valid_date_and_single_feature': valid_date_and_single_feature,
+        }
+
+    def log_stats(self, stats):
+        self.logger.info('Shapefile has %s features with %s distinct properties, %s of them with several features.', stats['feature_count'], stats['feature_props'], stats['multi_feature_props'])
+        self.logger.info('Shapefile has %s features without a PROP.', stats['blank_prop_count'])
+        self.logger.info('CSV file has %s rows, with %s distinct properties.', stats['item_count'], stats['item_props'])
+        self.logger.info('CSV file has %s "0" dates, and %s invalid dates.', stats['zero_date_count'], stats['invalid_date_count'])
         self.logger.info('CSV file references %s properties not found in shapefile; '
-            'shapefile references %s properties not found in CSV.' % (len(csv_props_missing_from_shapefile),
-            len(shapefile_props_missing_from_csv)))
-
-        valid_date_count = item_count - invalid_date_count - zero_date_count
-        self.logger.info('%s CSV rows with valid dates. %s have no mapping, %s have multiple mappings, %s have a single mapping.' % \
-            (valid_date_count, valid_date_but_no_feature, valid_date_but_multi_feature, valid_date_and_single_feature))
-
+            'shapefile references %s properties not found in CSV.', stats['csv_props_missing_from_shapefile'],
+            stats['shapefile_props_missing_from_csv'])
+        self.logger.info('%s CSV rows with valid dates. %s have no mapping, %s have multiple mappings, %s have a single mapping.',
+            stats['valid_date_count'], stats['valid_date_but_no_feature'], stats['valid_date_but_multi_feature'], stats['valid_date_and_single_feature'])
 
     def parse_date(self, string_value, rownum=None):
         if len(string_value) < 6 or len(string_value) > 8:
+            if string_value != '0':
+                self.date_errors.append((rownum, string_value))
             self.logger.error('%sUnable to parse %s into year, month, day.' % (rownum and 'Row %s: ' % rownum or '', string_value))
         elif string_value != '0':
             year = int(string_value[-4:])
@@ -149,6 +317,7 @@ class PropertyTransactions(BaseScraper):
             try:
                 return datetime.date(year, mm, dd)
             except ValueError, e:
+                self.date_errors.append((rownum, string_value))
                 message = '%sUnable to parse date %s (year=%s, month=%s, day=%s): %s' % (rownum and 'Row %s: ' % rownum or '',
                     string_value, year, mm, dd, e)
                 self.logger.error(message)
@@ -243,12 +412,46 @@ class PropertyTransactions(BaseScraper):
         )
 
 
+# state of a worker process of PropertyTransactions._update_parallel()
+_worker = None
+
+
+def _init_worker(parcel_path):
+    global _worker
+    _worker = (PropertyTransactions(), SqliteParcelIndex(path=parcel_path))
+
+
+def _import_chunk(args):
+    """
+    Imports one chunk of CSV rows in a worker process, returning
+    (first row, rows, import_chunk() counts, date errors).
+    """
+    start, rows = args
+    scraper, parcels = _worker
+    scraper.date_errors = []
+    counts = scraper.import_chunk(rows, parcels, start)
+    return start, len(rows), counts, scraper.date_errors
+
+
 def main():
     parser = OptionParser()
     parser.add_option('-c', '--clear', help='Clear schema',
                       action="store_true", dest="clear")
     parser.add_option('-s', '--stats', help='Report file stats only',
                       action="store_true", dest="stats")
+    parser.add_option('-j', '--json', action='store_true', dest='json',
+                      help='Print the --stats report as JSON')
+    parser.add_option('-i', '--parcel-index', dest='parcel_index',
+                      choices=sorted(PARCEL_INDEXES), default='memory',
+                      help='Hold parcels in memory (default) or, for very '
+                           'large layers, in a temporary sqlite file')
+    parser.add_option('-w', '--workers', type='int', dest='workers',
+                      default=1,
+                      help='Import the CSV in chunks on this many processes, '
+                           'sharing a sqlite parcel index')
+    parser.add_option('--chunk-size', type='int', dest='chunk_size',
+                      default=5000,
+                      help='CSV rows saved per transaction')
     add_verbosity_options(parser)
     opts, args = parser.parse_args(sys.argv)
     setup_logging_from_opts(opts, logger)
@@ -256,14 +459,21 @@ def main():
         parser.error("Please specify a CSV file and shapefile to import")
     csv_name, shp_name = args[1], args[2]
     csvreader = csv.DictReader(open(csv_name))
-    layer = DataSource(shp_name)[0]
 
     prop_trans = PropertyTransactions(clear=opts.clear)
 
     if opts.stats:
-        prop_trans.stats(csvreader, layer)
+        # only the PROP numbers are needed, read from the shapefile's .dbf
+        stats = prop_trans.stats(csvreader,
+                                 os.path.splitext(shp_name)[0] + '.dbf')
+        if opts.json:
+            print json.dumps(stats, indent=2, sort_keys=True)
+        else:
+            prop_trans.log_stats(stats)
     else:
-        prop_trans.update(csvreader, layer)
+        layer = DataSource(shp_name)[0]
+        prop_trans.update(csvreader, layer, opts.parcel_index, opts.workers,
+                          opts.chunk_size)
 
 
 if __name__ == '__main__':
@@ -4,6 +4,7 @@ import sys
 import csv
 import logging
 import datetime
+import itertools
 import traceback
 from optparse import OptionParser
 
@@ -23,6 +24,11 @@ from ebdata.retrieval.scrapers.base import BaseScraper
 # to do this if we used the scraper framework in ebdata?
 from ebdata.retrieval.utils import convert_entities
 
+from openrural.retrieval.fingerprints import FingerprintSet, row_digest, \
+    NEW, UNCHANGED
+from openrural.retrieval.geocoders import GeocodeMemo, GeocoderPool, \
+    get_shared_geocoder
+
 
 logger = logging.getLogger('openrural.retrieval.whiteville_resturants')
 
@@ -71,24 +77,72 @@ ESTABLISHMENT_TYPE_CODES = {
 class RestaurantInspections(BaseScraper):
 
     schema_slug = 'restaurant-inspections'
-    geocoder = geocoder.SmartGeocoder()
+    # rows read at a time when geocoding in worker processes
+    chunk_size = 500
 
     def __init__(self, *args, **kwargs):
         clear = kwargs.pop('clear', False)
+        self.geocode_workers = kwargs.pop('geocode_workers', 1)
         super(RestaurantInspections, self).__init__(*args, **kwargs)
         if clear:
             self._create_schema()
         self.schema = Schema.objects.get(slug=SCHEMA_SLUG)
         self.num_added = 0
+        self.num_changed = 0
+        self.num_unchanged = 0
+        self.geocoder = get_shared_geocoder()
+        # one row per violation item, so establishments repeat a lot
+        self.memo = GeocodeMemo(self.geocoder)
 
     def update(self, filename):
-        with open(filename, 'rb') as f:
-            reader = csv.reader(f)
-            reader.next() # skip header
-            for row in reader:
-                self.parse_row(row)
+        pool = None
+        if self.geocode_workers > 1:
+            pool = GeocoderPool(self.geocode_workers, type(self.geocoder))
+        try:
+            with open(filename, 'rb') as f:
+                reader = csv.reader(f)
+                reader.next() # skip header
+                while True:
+                    rows = list(itertools.islice(reader, self.chunk_size))
+                    if not rows:
+                        break
+                    fingerprints = FingerprintSet(
+                        self.schema, [self.row_key(row) for row in rows])
+                    pending = []
+                    for row in rows:
+                        status, fingerprint = fingerprints.status(
+                            self.row_key(row), row_digest(row))
+                        if status == UNCHANGED:
+                            self.num_unchanged += 1
+                        else:
+                            pending.append(row)
+                    if pool is not None:
+                        self.memo.prefetch([(self.address(row), row[6])
+                                            for row in pending], pool)
+                    for row in pending:
+                        self.parse_row(row, fingerprints)
+        finally:
+            if pool is not None:
+                pool.close()
+        self.logger.info("Created %d items, changed %d, %d unchanged",
+                         self.num_added, self.num_changed, self.num_unchanged)
+        looked_up = self.memo.hits + self.memo.misses
+        if looked_up:
+            self.logger.info("Geocoded %d addresses, %d (%.2f%%) were repeats",
+                             looked_up, self.memo.hits,
+                             100.0 * self.memo.hits / looked_up)
 
-    def parse_row(self, row):
+    def row_key(self, row):
+        """
+        The natural key of a row: restaurant, inspection date and item.
+        """
+        return ':'.join([row[0], row[9], row[11], row[13]])
+
+    def parse_row(self, row, fingerprints=None):
+        """
+        Saves a NewsItem for ``row``, or updates the one saved from an
+        earlier version of the row in ``fingerprints``.
+        """
         title = filters.title(row[1])
         item_date = datetime.datetime.strptime(row[9], "%m/%d/%Y")
         attrs = {
@@ -101,28 +155,48 @@ class RestaurantInspections(BaseScraper):
             'activity_item_id': row[13],
             'activity_item_comment': row[14],
         }
-        address = "%s, %s, %s %s" % (filters.title(row[3]),
-                                     filters.title(row[4]), row[5], row[6])
+        address = self.address(row)
+        key, digest = self.row_key(row), row_digest(row)
+        status, fingerprint = NEW, None
+        if fingerprints is not None:
+            status, fingerprint = fingerprints.status(key, digest,
+                                                      claim=True)
         try: 
-            self.create_newsitem(
-                attrs,
-                title=title,
-                item_date=item_date,
-                location_name=address,
-                zipcode=row[6],
-            )
+            if status == NEW:
+                news_item = self.create_newsitem(
+                    attrs,
+                    title=title,
+                    item_date=item_date,
+                    location_name=address,
+                    zipcode=row[6],
+                )
+            else:
+                news_item = fingerprint.news_item
+                values = {
+                    'title': title,
+                    'item_date': item_date.date(),
+                    'location_name': address,
+                }
+                location = self.geocode(address, row[6])
+                # keep the old point if the address no longer geocodes
+                if location:
+                    values['location'] = location['point']
+                self.update_existing(news_item, values, attrs)
+            if fingerprints is not None:
+                fingerprints.save(key, digest, news_item)
         except geocoder.InvalidBlockButValidStreet, e:
-            message = "InvalidBlockButValidStreet: %s" % address
-            self.logger.error(message)
+            self.logger.error("InvalidBlockButValidStreet: %s", address)
         except geocoder.DoesNotExist, e:
-            message = "DoesNotExist: %s" % address
-            self.logger.error(message)
+            self.logger.error("DoesNotExist: %s", address)
         except ImproperCity, e:
-            message = "ImproperCity: %s" % address
-            self.logger.error(message)
+            self.logger.error("ImproperCity: %s", address)
+
+    def address(self, row):
+        return "%s, %s, %s %s" % (filters.title(row[3]),
+                                  filters.title(row[4]), row[5], row[6])
 
     def geocode(self, location_name, zipcode):
-        location = self.geocoder.geocode(location_name)
+        location = self.memo.geocode(location_name, zipcode)
         return location
 
     def _create_schema(self):
@@ -199,13 +273,17 @@ def main():
     parser = OptionParser()
     parser.add_option('-c', '--clear', help='Clear schema',
                       action="store_true", dest="clear")
+    parser.add_option('-g', '--geocode-workers', type='int', default=1,
+                      dest='geocode_workers',
+                      help='Number of processes geocoding addresses')
     add_verbosity_options(parser)
     opts, args = parser.parse_args(sys.argv)
     setup_logging_from_opts(opts, logger)
     if len(args) != 2:
         parser.error("Please specify a CSV file to import")
     filename = args[1]
-    RestaurantInspections(clear=opts.clear).update(filename)
+    RestaurantInspections(clear=opts.clear,
+                          geocode_workers=opts.geocode_workers).update(filename)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+from django.db import connection, models, transaction
+
+from ebpub.db.models import Attribute, field_mapping
+
+
+__all__ = ('bulk_insert', 'NewsItemWriter')
+
+
+def bulk_insert(model, objs):
+    """
+    Inserts ``objs``, instances of ``model``, with a single executemany().
+    Unlike save(), this does not set auto-generated primary keys on them.
+    """
+    if not objs:
+        return
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_fields
+              if not isinstance(f, models.AutoField)]
+    sql = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+        qn(model._meta.db_table),
+        ', '.join([qn(f.column) for f in fields]),
+        ', '.join(['%s'] * len(fields)),
+    )
+    rows = []
+    for obj in objs:
+        rows.append([f.get_db_prep_save(f.pre_save(obj, True),
+                                        connection=connection)
+                     for f in fields])
+    cursor = connection.cursor()
+    cursor.executemany(sql, rows)
+
+
+class NewsItemWriter(object):
+    """
+    Buffers new NewsItems, along with their attributes and any related
+    rows pointing at them (e.g. error_log.Geocode), and writes each buffer
+    in one transaction.
+
+    NewsItems are still saved one at a time, since their ids are needed
+    for the rows that reference them; attribute rows and related rows are
+    inserted in bulk.
+    """
+
+    def __init__(self):
+        self.pending = []
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, news_item, attributes, related=()):
+        """
+        Queues an unsaved NewsItem. ``related`` is a list of unsaved model
+        instances whose ``news_item`` is set once the item has been saved.
+        """
+        self.pending.append((news_item, attributes, list(related)))
+
+    def flush(self):
+        """
+        Writes everything queued so far and returns the saved NewsItems.
+        If the write fails the transaction is rolled back and the buffer is
+        kept, with the NewsItems unsaved again, so a later flush() can
+        retry it.
+        """
+        pending = self.pending
+        if not pending:
+            return []
+        try:
+            with transaction.commit_on_success():
+                self._write(pending)
+        except:
+            for news_item, a, r in pending:
+                news_item.pk = None
+            raise
+        self.pending = []
+        return [news_item for news_item, a, r in pending]
+
+    def _write(self, pending):
+        mappings = field_mapping(list(set([news_item.schema_id
+                                           for news_item, a, r in pending])))
+        # {attribute columns: rows}, since each schema maps its own columns
+        attribute_rows = {}
+        related_rows = {}
+        for news_item, attributes, related in pending:
+            news_item.save()
+            mapping = mappings.get(news_item.schema_id, {}).items()
+            if attributes and mapping:
+                # values go to the cursor as they are, like
+                # AttributesDescriptor.__set__() does
+                columns = tuple([real_name for name, real_name in mapping])
+                attribute_rows.setdefault(columns, []).append(
+                    [news_item.pk, news_item.schema_id] +
+                    [attributes.get(name) for name, real_name in mapping])
+            for obj in related:
+                obj.news_item = news_item
+                related_rows.setdefault(type(obj), []).append(obj)
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        for columns, rows in attribute_rows.iteritems():
+            sql = 'INSERT INTO {0} (news_item_id, schema_id, {1}) ' \
+                  'VALUES ({2})'.format(
+                      qn(Attribute._meta.db_table),
+                      ', '.join([qn(column) for column in columns]),
+                      ', '.join(['%s'] * (len(columns) + 2)))
+            cursor.executemany(sql, rows)
+        for model, objs in related_rows.iteritems():
+            bulk_insert(model, objs)
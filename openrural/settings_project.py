@@ -3,6 +3,8 @@ Copy this to settings.py, uncomment the various settings, and
 edit them as desired.
 """
 
+import datetime
+
 from ebpub.settings_default import *
 
 ########################
@@ -90,6 +92,13 @@ DEFAULT_DAYS = 7
 # or you'll likely have "File name too long" errors.)
 HTTP_CACHE = '/tmp/openblock_scraper_cache_openrural'
 
+# Where the import commands keep downloaded GIS archives (see
+# openrural.downloads), how large that may grow, in bytes, and how long a
+# download is trusted before checking the server for a newer one.
+DOWNLOAD_CACHE_DIR = '/tmp/openrural_downloads'
+DOWNLOAD_CACHE_MAX_SIZE = 4 * 1024 ** 3
+DOWNLOAD_CACHE_MAX_AGE = datetime.timedelta(days=7)
+
 CACHES = {
     # Use whatever Django cache backend you like;
     # FileBasedCache is a reasonable choice for low-budget, memory-constrained
@@ -102,3 +111,24 @@ CACHES = {
     }
 }
 
+
+# Which geocoder the scrapers and the error log use: 'openblock' (the
+# stock SQL-backed SmartGeocoder), 'memory' (the blocks and intersections
+# held in memory, see openrural.retrieval.streetindex) or 'google'.
+OPENRURAL_GEOCODER = 'openblock'
+
+# Each process shares one geocoder remembering its most recent lookups
+# (see openrural.retrieval.geocoders.CachingGeocoder); failures are
+# forgotten sooner, as fixing streets can make them succeed.
+SHARED_GEOCODER_CACHE_SIZE = 1000
+SHARED_GEOCODER_ERROR_TTL = datetime.timedelta(minutes=10)
+
+# Days error_log rows are kept by the prune_error_log command, per model
+# and optionally per scraper (Geocode, GeocodeBatch) or logger (Message,
+# MessageGroup); see openrural.error_log.retention.
+ERROR_LOG_RETENTION = {
+    'Geocode': {'default': 90},
+    'GeocodeBatch': 365,
+    'Message': 30,
+    'MessageGroup': 90,
+}
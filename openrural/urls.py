@@ -27,6 +27,9 @@ urlpatterns = patterns(
 
     (r'^admin/', include(admin.site.urls)),
 
+    (r'^error_log/geocode-stats\.json$',
+     'openrural.error_log.views.geocode_stats'),
+
     # ebpub provides all the UI for an openblock site.
     (r'^', include('ebpub.urls')),
 )